@@ -1,14 +1,39 @@
+import hashlib
+import json
+import logging
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+import click
+from flask import (Flask, Response, render_template, request, redirect, url_for, flash, abort,
+                   jsonify, make_response, session, stream_with_context)
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from flask_mail import Mail, Message
+from flask_mail import Mail
 from itsdangerous import URLSafeTimedSerializer
+from markupsafe import Markup, escape
+from werkzeug.middleware.proxy_fix import ProxyFix
+import cache
 import database
+import exporter
+import importer
+import index_advisor
+import migrations
+import outbox
+import passwords
+import ratelimit
 from models import User
+from validation import validate_entry
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'espresso-tracker-secret-key-change-in-production')
 
+# Number of reverse proxies in front of the app, so request.remote_addr is the client's IP
+PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+if PROXY_FIX_X_FOR:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_X_FOR)
+
 # Configure Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -16,10 +41,22 @@ login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
 
+# Session users, so authenticated requests don't query the user table each time
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 1000))
+user_cache = cache.PageCache(max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL)
+database.add_user_listener(user_cache.invalidate_key)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    """Load user from database for Flask-Login."""
-    user_dict = database.get_user_by_id(int(user_id))
+    """Load user for Flask-Login (without the password hash), from user_cache."""
+    user_id = int(user_id)
+    user_dict = user_cache.get(user_id)
+    if user_dict is None:
+        user_dict = database.get_user_profile(user_id)
+        if user_dict:
+            user_cache.set(user_id, user_dict)
     return User.from_dict(user_dict) if user_dict else None
 
 # Configure Flask-Mail
@@ -32,19 +69,60 @@ app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', app.co
 
 mail = Mail(app)
 
+# Where queued email is sent from: 'thread' (a background thread in each web
+# worker) or 'worker' (a separate `flask send-emails` process)
+EMAIL_SENDER = os.environ.get('EMAIL_SENDER', 'thread')
+EMAIL_SEND_INTERVAL = float(os.environ.get('EMAIL_SEND_INTERVAL', 10))
+
+# Expose /metrics (keep it off unless the endpoint is not publicly reachable)
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+
+# Per-request SQL statistics. SERVER_TIMING adds them to a Server-Timing header
+# (debugging only: it shows query timings to clients) and QUERY_LOG logs them for
+# every request. Requests running more than QUERY_BUDGET statements, or one
+# statement more than QUERY_REPEAT_BUDGET times (N+1 queries), are always logged
+# as warnings.
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', 'false').lower() == 'true'
+app.config['QUERY_LOG'] = os.environ.get('QUERY_LOG', 'false').lower() == 'true'
+QUERY_BUDGET = int(os.environ.get('QUERY_BUDGET', 30))
+QUERY_REPEAT_BUDGET = int(os.environ.get('QUERY_REPEAT_BUDGET', 10))
+if app.config['QUERY_LOG'] and app.logger.getEffectiveLevel() > logging.INFO:
+    app.logger.setLevel(logging.INFO)
+
+# Login throttling: token buckets per client IP and per email. The sqlite
+# backend shares the buckets between worker processes.
+login_limiter = ratelimit.LoginLimiter(
+    backend=os.environ.get('LOGIN_RATE_LIMIT_BACKEND', 'memory'),
+    ip_burst=int(os.environ.get('LOGIN_IP_BURST', 20)),
+    ip_per_minute=float(os.environ.get('LOGIN_IP_PER_MINUTE', 10)),
+    email_burst=int(os.environ.get('LOGIN_EMAIL_BURST', 5)),
+    email_per_minute=float(os.environ.get('LOGIN_EMAIL_PER_MINUTE', 2)),
+)
+
+# Entries shown per page on the index feeds
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 20))
+
+# Rendered pages served to logged-out visitors, and the coffee list and stats,
+# dropped when their entries change (in this or any other worker process)
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 60))
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 500))
+page_cache = cache.PageCache(max_entries=PAGE_CACHE_MAX_ENTRIES, ttl=PAGE_CACHE_TTL)
+data_cache = cache.PageCache(max_entries=PAGE_CACHE_MAX_ENTRIES, ttl=PAGE_CACHE_TTL)
+
 # Password reset token serializer
 serializer = URLSafeTimedSerializer(app.secret_key)
 
-# Initialize database on startup
-database.init_db()
+# Schema changes run at deploy time (`flask db-upgrade`); workers only check the version
+database.init_app(app)
+migrations.check()
 
 
 def send_password_reset_email(user, token):
-    """Send password reset email."""
+    """Queue the password reset email for the outbox sender."""
     reset_url = url_for('reset_password', token=token, _external=True)
-    msg = Message(
+    outbox.enqueue(
+        recipient=user.email,
         subject='Reset Your Password - Espresso Tracker',
-        recipients=[user.email],
         body=f'''To reset your password, visit the following link:
 {reset_url}
 
@@ -53,36 +131,248 @@ This link will expire in 1 hour.
 If you did not request a password reset, please ignore this email.
 '''
     )
-    try:
-        mail.send(msg)
-    except Exception as e:
-        app.logger.error(f'Failed to send email: {e}')
+
+
+@app.before_request
+def start_email_sender():
+    """Start this worker's outbox sender thread on its first request."""
+    if EMAIL_SENDER == 'thread':
+        outbox.start_sender(app, mail, EMAIL_SEND_INTERVAL)
+
+
+def _invalidate_caches(coffee_names, catalog_changed):
+    """Drop cached pages and data showing entries of the changed coffees."""
+    tags = ['index'] + [f'coffee:{name}' for name in coffee_names]
+    if catalog_changed:
+        tags.append('catalog')
+    for tag in tags:
+        page_cache.invalidate(tag)
+        data_cache.invalidate(tag)
+
+
+database.add_change_listener(_invalidate_caches)
+
+
+@app.before_request
+def poll_database_changes():
+    """Pick up writes made by other worker processes before serving from the caches."""
+    if page_cache.enabled or data_cache.enabled:
+        database.poll_changes()
+
+
+@app.after_request
+def report_queries(response):
+    """Report the request's SQL statement count and timings (see QUERY_BUDGET)."""
+    stats = database.query_stats() or database.QueryStats()
+    repeated_sql, repeats = stats.most_repeated()
+    over_budget = stats.count > QUERY_BUDGET or repeats > QUERY_REPEAT_BUDGET
+    
+    if app.config['SERVER_TIMING']:
+        response.headers.add('Server-Timing',
+                             f'db;desc="{stats.count} queries";dur={stats.total * 1000:.2f}')
+        if stats.count:
+            response.headers.add('Server-Timing',
+                                 f'db-slowest;dur={stats.slowest * 1000:.2f}')
+    
+    if over_budget or app.config['QUERY_LOG']:
+        record = {
+            'event': 'request_queries',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'queries': stats.count,
+            'query_ms': round(stats.total * 1000, 2),
+            'slowest_ms': round(stats.slowest * 1000, 2),
+            'slowest_sql': _one_line(stats.slowest_sql),
+        }
+        if over_budget:
+            record.update(over_budget=True, query_budget=QUERY_BUDGET,
+                          most_repeated=repeats, most_repeated_sql=_one_line(repeated_sql))
+            app.logger.warning(json.dumps(record))
+        else:
+            app.logger.info(json.dumps(record))
+    return response
+
+
+def _one_line(sql, max_length=200):
+    """Collapse a statement's whitespace for logging, truncated to max_length."""
+    if sql is None:
+        return None
+    sql = ' '.join(sql.split())
+    return sql if len(sql) <= max_length else sql[:max_length - 1] + '…'
+
+
+def _get_coffees():
+    """Coffee names with entries, from data_cache."""
+    coffees = data_cache.get('coffees')
+    if coffees is None:
+        coffees = database.get_all_coffees()
+        data_cache.set('coffees', coffees, tags=('catalog',))
+    return coffees
+
+
+def _get_coffee_stats(coffee_name):
+    """Statistics for one coffee, from data_cache."""
+    key = ('stats', coffee_name)
+    stats = data_cache.get(key)
+    if stats is None:
+        stats = database.get_coffee_stats(coffee_name)
+        if stats is not None:
+            data_cache.set(key, stats, tags=(f'coffee:{coffee_name}',))
+    return stats
+
+
+def _page_cache_key():
+    """Key for the current request in page_cache, or None if it can't be cached.
+    Only anonymous pages without pending flash messages are shared.
+    """
+    if not page_cache.enabled or current_user.is_authenticated or '_flashes' in session:
+        return None
+    return request.endpoint, request.path, tuple(sorted(request.args.items(multi=True)))
+
+
+def _page_validators(version, *extra):
+    """Build the (etag, last_modified) cache validators for a page.
+    version is a database (count, updated_at) pair; extra is any other data the
+    page shows. The ETag varies by user. Returns None when the page must not be
+    cached because it will show pending flash messages.
+    """
+    if '_flashes' in session:
+        return None
+    user_id = current_user.id if current_user.is_authenticated else None
+    key = repr((request.endpoint, user_id, tuple(version)) + extra)
+    etag = hashlib.sha1(key.encode()).hexdigest()
+    
+    # HTTP dates are in whole seconds, so a change later in the same second
+    # would get the same Last-Modified and If-Modified-Since would miss it.
+    # The date is only sent once that second is over; until then the ETag
+    # validates the page alone.
+    last_modified = None
+    if version[1]:
+        changed = datetime.fromisoformat(version[1]).replace(microsecond=0, tzinfo=timezone.utc)
+        if changed + timedelta(seconds=1) <= datetime.now(timezone.utc):
+            last_modified = changed
+    return etag, last_modified
+
+
+def _not_modified(validators):
+    """Return a 304 response if the client's cached copy is current, else None.
+    If-None-Match takes precedence over If-Modified-Since.
+    """
+    if not validators:
+        return None
+    etag, last_modified = validators
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = (last_modified is not None and request.if_modified_since is not None
+                 and last_modified <= request.if_modified_since)
+    if not fresh:
+        return None
+    return _with_validators(Response(status=304), validators)
+
+
+def _with_validators(response, validators):
+    """Attach cache validators; clients must revalidate before reusing the page."""
+    if validators:
+        etag, last_modified = validators
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+    return response
 
 
 @app.route('/')
 def index():
-    """Display all entries with coffee filter option."""
+    """Display entries one page at a time with coffee filter option.
+    The feed and cursor query args page through one section (user or community).
+    """
     user_id = current_user.id if current_user.is_authenticated else None
-    entries = database.get_all_entries(user_id)
-    coffees = database.get_all_coffees()
+    feed = request.args.get('feed')
+    cursor = request.args.get('cursor')
+    
+    validators = _page_validators(database.get_entries_version())
+    not_modified = _not_modified(validators)
+    if not_modified:
+        return not_modified
+    
+    cache_key = _page_cache_key()
+    html = page_cache.get(cache_key) if cache_key else None
+    if html is not None:
+        return _with_validators(make_response(html), validators)
+    
+    coffees = _get_coffees()
     
     # Separate user entries from community entries
-    user_entries = []
-    community_entries = []
+    user_entries, user_next_cursor = [], None
+    community_entries, community_next_cursor = [], None
     
-    for entry in entries:
-        entry['extraction_ratio'] = database.calculate_extraction_ratio(
-            entry['input_weight'], entry['output_weight']
+    if user_id and feed != 'community':
+        user_entries, user_next_cursor = _get_entries_page(
+            'user', user_id, cursor if feed == 'user' else None
+        )
+    if feed != 'user':
+        community_entries, community_next_cursor = _get_entries_page(
+            'community', user_id, cursor if feed == 'community' else None
         )
-        if user_id and entry.get('user_id') == user_id:
-            user_entries.append(entry)
-        else:
-            community_entries.append(entry)
     
-    return render_template('index.html', 
+    html = render_template('index.html', 
                          user_entries=user_entries, 
                          community_entries=community_entries,
+                         user_next_cursor=user_next_cursor,
+                         community_next_cursor=community_next_cursor,
                          coffees=coffees)
+    if cache_key:
+        page_cache.set(cache_key, html, tags=('index',))
+    return _with_validators(make_response(html), validators)
+
+
+@app.route('/entries/feed')
+def entries_feed():
+    """Return the next page of entry cards as an HTML fragment (infinite scroll)."""
+    feed = request.args.get('feed', 'community')
+    if feed not in ('user', 'community'):
+        abort(400)
+    user_id = current_user.id if current_user.is_authenticated else None
+    if feed == 'user' and not user_id:
+        abort(401)
+    
+    entries, next_cursor = _get_entries_page(feed, user_id, request.args.get('cursor'))
+    return render_template('entry_feed.html', entries=entries, feed=feed,
+                         next_cursor=next_cursor, target=f'{feed}-entries')
+
+
+@app.route('/search')
+def search():
+    """Full-text search over entries, ranked by relevance."""
+    query = request.args.get('q', '').strip()
+    entries, next_cursor = [], None
+    
+    if query:
+        try:
+            entries = database.search_entries(
+                query, cursor=database.parse_cursor(request.args.get('cursor'), float),
+                limit=PAGE_SIZE + 1
+            )
+        except sqlite3.OperationalError as e:
+            app.logger.error(f'Search failed: {e}')
+            flash('Search is currently unavailable', 'error')
+        if len(entries) > PAGE_SIZE:
+            entries = entries[:PAGE_SIZE]
+            next_cursor = database.make_cursor(entries[-1], key='rank')
+    
+    return render_template('search.html', query=query, entries=entries,
+                         next_cursor=next_cursor)
+
+
+@app.template_filter('highlight')
+def highlight_filter(snippet):
+    """Escape a search snippet and turn its match markers into <mark> tags."""
+    return Markup(str(escape(snippet or ''))
+                  .replace(database.SNIPPET_START, '<mark>')
+                  .replace(database.SNIPPET_END, '</mark>'))
 
 
 @app.route('/add', methods=['GET', 'POST'])
@@ -97,24 +387,12 @@ def add_entry():
         taste_comment = request.form.get('taste_comment', '').strip()
         
         # Validation
-        errors = []
-        if not coffee:
-            errors.append('Coffee name is required')
-        if not grinder_setting:
-            errors.append('Grinder setting is required')
-        if not input_weight:
-            errors.append('Input weight is required')
-        elif not _is_valid_number(input_weight):
-            errors.append('Input weight must be a valid number')
-        if not output_weight:
-            errors.append('Output weight is required')
-        elif not _is_valid_number(output_weight):
-            errors.append('Output weight must be a valid number')
+        errors = validate_entry(coffee, grinder_setting, input_weight, output_weight)
         
         if errors:
             for error in errors:
                 flash(error, 'error')
-            coffees = database.get_all_coffees()
+            coffees = _get_coffees()
             return render_template('add_entry.html', coffees=coffees,
                                  coffee=coffee, grinder_setting=grinder_setting,
                                  input_weight=input_weight, output_weight=output_weight,
@@ -134,14 +412,62 @@ def add_entry():
             return redirect(url_for('view_entry', entry_id=entry_id))
         except Exception as e:
             flash(f'Error adding entry: {str(e)}', 'error')
-            coffees = database.get_all_coffees()
+            coffees = _get_coffees()
             return render_template('add_entry.html', coffees=coffees)
     
     # GET request - show form
-    coffees = database.get_all_coffees()
+    coffees = _get_coffees()
     return render_template('add_entry.html', coffees=coffees)
 
 
+@app.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_entries():
+    """Bulk import entries from an uploaded CSV or JSON Lines file."""
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Please choose a file to import', 'error')
+            return render_template('import.html')
+        
+        fmt = request.form.get('format') or importer.detect_format(upload.filename)
+        if fmt not in importer.FORMATS:
+            flash(f'Unsupported format: {fmt}', 'error')
+            return render_template('import.html')
+        
+        try:
+            result = importer.import_entries(importer.open_text(upload.stream),
+                                             current_user.id, fmt=fmt)
+        except Exception as e:
+            flash(f'Import failed: {str(e)}', 'error')
+            return render_template('import.html')
+        
+        flash(f'Imported {result["imported"]} entries', 'success' if result['imported'] else 'info')
+        return render_template('import.html', result=result)
+    
+    return render_template('import.html')
+
+
+EXPORT_FORMATS = {
+    'csv': (exporter.iter_csv, 'text/csv'),
+    'ndjson': (exporter.iter_ndjson, 'application/x-ndjson'),
+}
+
+
+@app.route('/export.<fmt>')
+@login_required
+def export_entries(fmt):
+    """Stream all of the current user's entries as CSV or NDJSON."""
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    
+    render, mimetype = EXPORT_FORMATS[fmt]
+    rows = database.iter_user_entries(current_user.id)
+    return Response(stream_with_context(render(rows)), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=espresso-entries.{fmt}',
+    })
+
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     """User registration."""
@@ -182,6 +508,9 @@ def register():
         except ValueError as e:
             flash(str(e), 'error')
             return render_template('register.html', email=email)
+        except passwords.HashingBusy as e:
+            flash(str(e), 'error')
+            return render_template('register.html', email=email), 503
         except Exception as e:
             flash(f'Registration failed: {str(e)}', 'error')
             return render_template('register.html', email=email)
@@ -204,8 +533,25 @@ def login():
             flash('Please enter both email and password', 'error')
             return render_template('login.html', email=email)
         
+        if not login_limiter.allow(request.remote_addr, email):
+            flash('Too many login attempts, please wait a minute and try again', 'error')
+            return render_template('login.html', email=email), 429
+        
         user_dict = database.get_user_by_email(email)
-        if user_dict and database.verify_password(user_dict, password):
+        try:
+            valid = user_dict and database.verify_password(user_dict, password)
+        except passwords.HashingBusy as e:
+            flash(str(e), 'error')
+            return render_template('login.html', email=email), 503
+        
+        if valid:
+            # Upgrade hashes made with an older method or cost while we have the password
+            if passwords.needs_rehash(user_dict['password_hash']):
+                try:
+                    database.update_user_password(user_dict['id'], password)
+                except passwords.HashingBusy:
+                    pass
+            
             user = User.from_dict(user_dict)
             login_user(user, remember=remember)
             next_page = request.args.get('next')
@@ -298,6 +644,9 @@ def reset_password(token):
             database.update_user_password(user_dict['id'], password)
             flash('Password reset successful! Please log in.', 'success')
             return redirect(url_for('login'))
+        except passwords.HashingBusy as e:
+            flash(str(e), 'error')
+            return render_template('reset_password.html', token=token), 503
         except Exception as e:
             flash(f'Password reset failed: {str(e)}', 'error')
             return render_template('reset_password.html', token=token)
@@ -308,70 +657,70 @@ def reset_password(token):
 @app.route('/entry/<int:entry_id>')
 def view_entry(entry_id):
     """View a single entry."""
+    version = database.get_entry_version(entry_id)
+    validators = _page_validators(version) if version else None
+    not_modified = _not_modified(validators)
+    if not_modified:
+        return not_modified
+    
     entry = database.get_entry_by_id(entry_id)
     if not entry:
         flash('Entry not found', 'error')
         return redirect(url_for('index'))
     
-    entry['extraction_ratio'] = database.calculate_extraction_ratio(
-        entry['input_weight'], entry['output_weight']
-    )
-    
     # Check if user owns this entry
     is_owner = current_user.is_authenticated and entry.get('user_id') == current_user.id
     
-    return render_template('entry_detail.html', entry=entry, is_owner=is_owner)
+    return _with_validators(make_response(
+        render_template('entry_detail.html', entry=entry, is_owner=is_owner)
+    ), validators)
 
 
 @app.route('/coffee/<coffee_name>')
 def coffee_view(coffee_name):
-    """View all entries for a specific coffee."""
+    """View all entries for a specific coffee.
+    Query args sort ('newest' or 'ratio'), min_ratio and max_ratio are applied in SQL.
+    """
     user_id = current_user.id if current_user.is_authenticated else None
+    sort = request.args.get('sort', 'newest')
+    min_ratio = request.args.get('min_ratio', type=float)
+    max_ratio = request.args.get('max_ratio', type=float)
     
-    if user_id:
-        user_entries, anonymous_entries = database.get_user_and_anonymous_entries_by_coffee(
-            coffee_name, user_id
-        )
-        
-        # Calculate extraction ratios
-        for entry in user_entries:
-            entry['extraction_ratio'] = database.calculate_extraction_ratio(
-                entry['input_weight'], entry['output_weight']
-            )
-        for entry in anonymous_entries:
-            entry['extraction_ratio'] = database.calculate_extraction_ratio(
-                entry['input_weight'], entry['output_weight']
-            )
-        
-        if not user_entries and not anonymous_entries:
-            flash(f'No entries found for coffee: {coffee_name}', 'info')
-            return redirect(url_for('index'))
-        
-        coffees = database.get_all_coffees()
-        return render_template('coffee_view.html', 
-                             user_entries=user_entries,
-                             anonymous_entries=anonymous_entries,
-                             coffee_name=coffee_name, 
-                             coffees=coffees)
-    else:
-        entries = database.get_entries_by_coffee(coffee_name, None)
-        coffees = database.get_all_coffees()
-        
-        if not entries:
-            flash(f'No entries found for coffee: {coffee_name}', 'info')
-            return redirect(url_for('index'))
-        
-        # Calculate extraction ratios for each entry
-        for entry in entries:
-            entry['extraction_ratio'] = database.calculate_extraction_ratio(
-                entry['input_weight'], entry['output_weight']
-            )
-        
-        return render_template('coffee_view.html', 
-                             user_entries=[],
-                             anonymous_entries=entries,
-                             coffee_name=coffee_name, 
-                             coffees=coffees)
+    # The page also lists the other coffees, so they are part of its validators
+    version = database.get_coffee_version(coffee_name)
+    coffees = _get_coffees()
+    validators = _page_validators(version, tuple(coffees)) if version else None
+    not_modified = _not_modified(validators)
+    if not_modified:
+        return not_modified
+    
+    cache_key = _page_cache_key()
+    html = page_cache.get(cache_key) if cache_key else None
+    if html is not None:
+        return _with_validators(make_response(html), validators)
+    
+    user_entries, anonymous_entries = database.get_user_and_anonymous_entries_by_coffee(
+        coffee_name, user_id, min_ratio=min_ratio, max_ratio=max_ratio, sort=sort
+    )
+    
+    filtered = min_ratio is not None or max_ratio is not None
+    if not user_entries and not anonymous_entries and not filtered:
+        flash(f'No entries found for coffee: {coffee_name}', 'info')
+        return redirect(url_for('index'))
+    
+    stats = _get_coffee_stats(coffee_name)
+    html = render_template('coffee_view.html', 
+                         user_entries=user_entries,
+                         anonymous_entries=anonymous_entries,
+                         coffee_name=coffee_name, 
+                         coffees=coffees,
+                         stats=stats,
+                         sort=sort,
+                         min_ratio=min_ratio,
+                         max_ratio=max_ratio)
+    if cache_key:
+        page_cache.set(cache_key, html, tags=(f'coffee:{coffee_name}', 'catalog'))
+    return _with_validators(make_response(html), validators)
 
 
 @app.route('/entry/<int:entry_id>/edit', methods=['GET', 'POST'])
@@ -396,19 +745,7 @@ def edit_entry(entry_id):
         taste_comment = request.form.get('taste_comment', '').strip()
         
         # Validation
-        errors = []
-        if not coffee:
-            errors.append('Coffee name is required')
-        if not grinder_setting:
-            errors.append('Grinder setting is required')
-        if not input_weight:
-            errors.append('Input weight is required')
-        elif not _is_valid_number(input_weight):
-            errors.append('Input weight must be a valid number')
-        if not output_weight:
-            errors.append('Output weight is required')
-        elif not _is_valid_number(output_weight):
-            errors.append('Output weight must be a valid number')
+        errors = validate_entry(coffee, grinder_setting, input_weight, output_weight)
         
         if errors:
             for error in errors:
@@ -468,16 +805,257 @@ def delete_entry(entry_id):
         return redirect(url_for('view_entry', entry_id=entry_id))
 
 
-def _is_valid_number(value):
-    """Check if a string is a valid number."""
+def _get_entries_page(feed, user_id, cursor, limit=PAGE_SIZE, fields=None):
+    """Fetch one page of a feed. Returns (entries, next_cursor)."""
+    entries = database.get_all_entries(user_id, scope=feed,
+                                       cursor=database.parse_cursor(cursor),
+                                       limit=limit + 1, fields=fields)
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = database.make_cursor(entries[-1])
+    return entries, next_cursor
+
+
+# JSON API (v1)
+
+API_MAX_LIMIT = 100
+
+
+def _api_error(message, status):
+    """Return a JSON error response."""
+    return jsonify({'error': message}), status
+
+
+def api_login_required(view):
+    """Like login_required, but answers with a JSON 401 instead of a redirect."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return _api_error('Authentication required', 401)
+        return view(*args, **kwargs)
+    return wrapped
+
+
+def _api_fields():
+    """Parse the fields= query arg. Returns the requested field names (all by default)."""
+    fields = request.args.get('fields')
+    if not fields:
+        return list(database.ENTRY_FIELDS)
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+
+def _project(entry, fields):
+    """Keep only the requested fields of an entry row."""
+    return {field: entry[field] for field in fields}
+
+
+def _api_entry_values(payload, current=None):
+    """Validate an entry JSON payload, filling missing fields from current.
+    Returns (values, errors).
+    """
+    current = current or {}
+    values = {}
+    for field in ('coffee', 'grinder_setting', 'input_weight', 'output_weight', 'taste_comment'):
+        value = payload.get(field, current.get(field))
+        values[field] = '' if value is None else str(value).strip()
+    
+    errors = validate_entry(values['coffee'], values['grinder_setting'],
+                            values['input_weight'], values['output_weight'])
+    if not errors:
+        values['input_weight'] = float(values['input_weight'])
+        values['output_weight'] = float(values['output_weight'])
+    return values, errors
+
+
+@app.route('/api/v1/entries')
+def api_list_entries():
+    """List entries newest first, one page at a time.
+    Query args: scope ('all', 'user' or 'community'), cursor, limit and fields.
+    """
+    user_id = current_user.id if current_user.is_authenticated else None
+    scope = request.args.get('scope', 'all')
+    if scope not in ('all', 'user', 'community'):
+        return _api_error('scope must be one of all, user, community', 400)
+    if scope == 'user' and not user_id:
+        return _api_error('Authentication required', 401)
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), API_MAX_LIMIT)
+    
+    fields = _api_fields()
+    try:
+        entries, next_cursor = _get_entries_page(None if scope == 'all' else scope, user_id,
+                                                 request.args.get('cursor'),
+                                                 limit=limit, fields=fields)
+    except ValueError as e:
+        return _api_error(str(e), 400)
+    
+    return jsonify({
+        'entries': [_project(entry, fields) for entry in entries],
+        'next_cursor': next_cursor,
+    })
+
+
+@app.route('/api/v1/entries/<int:entry_id>')
+def api_get_entry(entry_id):
+    """Get a single entry. Query arg fields selects the returned fields."""
+    fields = _api_fields()
+    try:
+        entry = database.get_entry_by_id(entry_id, fields=fields)
+    except ValueError as e:
+        return _api_error(str(e), 400)
+    if not entry:
+        return _api_error('Entry not found', 404)
+    return jsonify(_project(entry, fields))
+
+
+@app.route('/api/v1/entries', methods=['POST'])
+@api_login_required
+def api_create_entry():
+    """Create an entry from a JSON body."""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return _api_error('Request body must be a JSON object', 400)
+    values, errors = _api_entry_values(payload)
+    if errors:
+        return jsonify({'errors': errors}), 400
+    
+    entry_id = database.add_entry(user_id=current_user.id, **values)
+    entry = database.get_entry_by_id(entry_id, fields=list(database.ENTRY_FIELDS))
+    response = jsonify(entry)
+    response.status_code = 201
+    response.headers['Location'] = url_for('api_get_entry', entry_id=entry_id)
+    return response
+
+
+@app.route('/api/v1/entries/<int:entry_id>', methods=['PUT', 'PATCH'])
+@api_login_required
+def api_update_entry(entry_id):
+    """Update an entry from a JSON body; fields left out keep their value."""
+    entry = database.get_entry_by_id(entry_id)
+    if not entry:
+        return _api_error('Entry not found', 404)
+    if entry['user_id'] != current_user.id:
+        return _api_error('You can only edit your own entries', 403)
+    
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return _api_error('Request body must be a JSON object', 400)
+    values, errors = _api_entry_values(payload, current=entry)
+    if errors:
+        return jsonify({'errors': errors}), 400
+    
+    try:
+        database.update_entry(entry_id, current_user.id, **values)
+    except PermissionError as e:
+        return _api_error(str(e), 403)
+    return jsonify(database.get_entry_by_id(entry_id, fields=list(database.ENTRY_FIELDS)))
+
+
+@app.route('/api/v1/entries/<int:entry_id>', methods=['DELETE'])
+@api_login_required
+def api_delete_entry(entry_id):
+    """Delete an entry."""
+    if not database.get_entry_by_id(entry_id, fields=['id']):
+        return _api_error('Entry not found', 404)
     try:
-        float(value)
-        return True
-    except ValueError:
-        return False
+        database.delete_entry(entry_id, current_user.id)
+    except PermissionError as e:
+        return _api_error(str(e), 403)
+    return '', 204
+
+
+@app.route('/api/v1/coffees')
+def api_list_coffees():
+    """List coffee names that have entries."""
+    return jsonify({'coffees': _get_coffees()})
+
+
+@app.route('/metrics')
+def metrics():
+    """Operational metrics in Prometheus text format (enabled by METRICS_ENABLED)."""
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    
+    lines = [
+        '# HELP password_hash_seconds Time spent hashing and checking passwords.',
+        '# TYPE password_hash_seconds summary',
+    ]
+    for op, stats in passwords.latency_metrics().items():
+        lines.append(f'password_hash_seconds_count{{op="{op}"}} {stats["count"]}')
+        lines.append(f'password_hash_seconds_sum{{op="{op}"}} {stats["total_seconds"]:.6f}')
+        lines.append(f'password_hash_seconds_max{{op="{op}"}} {stats["max_seconds"]:.6f}')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+@app.cli.command('import-entries')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--email', required=True, help='Owner of the imported entries.')
+@click.option('--format', 'fmt', type=click.Choice(importer.FORMATS),
+              help='File format (default: guessed from the file name).')
+@click.option('--chunk-size', default=importer.CHUNK_SIZE, show_default=True,
+              help='Rows inserted per transaction.')
+def import_entries_command(path, email, fmt, chunk_size):
+    """Bulk import entries from a CSV or JSON Lines file."""
+    user_dict = database.get_user_by_email(email.strip().lower())
+    if not user_dict:
+        raise click.ClickException(f'No user with email {email}')
+    
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        result = importer.import_entries(stream, user_dict['id'],
+                                         fmt=fmt or importer.detect_format(path),
+                                         chunk_size=chunk_size)
+    
+    for line_number, message in result['errors']:
+        click.echo(f'line {line_number}: {message}', err=True)
+    if result['error_count'] > len(result['errors']):
+        click.echo(f'... {result["error_count"] - len(result["errors"])} more errors', err=True)
+    click.echo(f'Imported {result["imported"]} entries, skipped {result["error_count"]} rows')
+
+
+@app.cli.command('send-emails')
+@click.option('--once', is_flag=True, help='Send what is due and exit.')
+def send_emails_command(once):
+    """Send queued email (run this when EMAIL_SENDER=worker)."""
+    while True:
+        sent = outbox.send_due(mail)
+        if sent:
+            click.echo(f'Sent {sent} emails')
+        if sent < outbox.BATCH_SIZE:
+            if once:
+                break
+            time.sleep(EMAIL_SEND_INTERVAL)
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations.
+
+    Safe to run while the app serves requests: table copies and backfills
+    commit in short chunks, and writers only wait (up to SQLITE_BUSY_TIMEOUT)
+    while one holds the write lock. At 1M entries the longest waits are
+    building each entry index (1-3 s, one at a time), the statistics of the
+    busiest coffee (about 1 s) and a table swap (about 0.5 s).
+    """
+    # Show applied migrations and table rebuild progress
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    migrations.upgrade()
+    click.echo(f'Database schema is at version {migrations.current_version()}')
+
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Flag queries in database.py that scan a whole table or sort in a temp B-tree."""
+    results = index_advisor.analyze()
+    for line in index_advisor.format_report(results):
+        click.echo(line)
+    
+    failures = [r for r in results if r['problems'] and not r['allowed']]
+    if failures:
+        raise click.ClickException(f'{len(failures)} quer{"y" if len(failures) == 1 else "ies"} without a matching index')
 
 
 if __name__ == '__main__':
-    # Development server only - production uses gunicorn
+    # Development server only - production uses gunicorn (after `flask db-upgrade`)
+    migrations.upgrade()
     port = int(os.environ.get('PORT', 5000))
     app.run(debug=False, host='0.0.0.0', port=port)
@@ -0,0 +1,840 @@
+"""Synthetic dataset generator and benchmark runner.
+
+Fill a database with N users and M entries (deterministic for a given seed):
+
+    python benchmark.py generate bench.db --entries 100000 --users 1000
+
+Time the public functions of database.py and the main routes (through the
+Flask test client) at several sizes, writing JSON results:
+
+    python benchmark.py run --sizes 10000 100000 1000000 --output results.json
+
+Generated databases are kept in --data-dir and reused by later runs. Each size
+is measured in a fresh process on a copy of its database, with the page cache
+disabled so routes do their full work every time.
+
+Compare against the committed baseline, exiting with status 1 if any tracked
+operation got slower than the tolerance allows:
+
+    python benchmark.py compare                      # runs the tracked benchmarks
+    python benchmark.py compare --results results.json
+    python benchmark.py compare --update             # record a new baseline
+
+The baseline's operations and sizes are the ones tracked. Timings depend on
+the machine, so record the baseline where the comparison runs (e.g. on CI).
+"""
+import argparse
+import inspect
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+import database
+import migrations
+import passwords
+
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+DEFAULT_SEED = 42
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'espresso-benchmark')
+BENCHMARK_PASSWORD = 'benchmark'
+
+# Each operation runs at least MIN_CALLS times and then until it has run
+# REPEAT times or for MAX_SECONDS, whichever comes first
+REPEAT = 1000
+MIN_CALLS = 3
+MAX_SECONDS = 1.0
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmarks', 'baseline.json')
+# Operations and sizes recorded by `compare --update`
+TRACKED = {
+    'database': ['get_all_entries', 'get_entry_by_id', 'get_entries_by_coffee', 'search_entries',
+                 'get_coffee_stats', 'add_entry', 'update_entry', 'delete_entry'],
+    'routes': ['index', 'index_logged_in', 'view_entry', 'coffee_view', 'search', 'add_entry',
+               'api_list_entries'],
+}
+TRACKED_SIZES = (10000, 100000)
+# Operations are compared on their fastest call. Scheduling, cache and I/O
+# noise only ever add time, so the minimum of many calls barely moves between
+# runs of the same code, while the median swung by more than 50% here. Whole
+# runs still drift with the machine's speed (by 25% on shared CI hosts), so the
+# baseline is scaled by the calibration workload's time in each run.
+GATE_STAT = 'min_ms'
+# A tracked operation regresses when its fastest time grows by more than this
+# fraction of the baseline, and by more than MIN_REGRESSION_MS (timer noise)
+TOLERANCE = 0.25
+MIN_REGRESSION_MS = 0.05
+# Regressed operations are measured this many more times before failing,
+# keeping the fastest, so one noisy run doesn't fail the comparison
+CONFIRM_RUNS = 2
+
+GENERATE_BATCH_SIZE = 10000
+OUTBOX_EMAILS = 1000
+
+ORIGINS = [
+    'Ethiopia Yirgacheffe', 'Ethiopia Guji', 'Ethiopia Sidamo', 'Kenya Nyeri', 'Kenya Kirinyaga',
+    'Colombia Huila', 'Colombia Narino', 'Colombia Cauca', 'Brazil Cerrado', 'Brazil Sul de Minas',
+    'Guatemala Antigua', 'Guatemala Huehuetenango', 'Costa Rica Tarrazu', 'Honduras Santa Barbara',
+    'El Salvador Santa Ana', 'Panama Boquete', 'Peru Cajamarca', 'Rwanda Nyamasheke',
+    'Burundi Kayanza', 'Sumatra Aceh', 'Yemen Haraz', 'Mexico Chiapas', 'Nicaragua Jinotega',
+    'India Chikmagalur',
+]
+PROCESSES = ['Washed', 'Natural', 'Honey', 'Anaerobic', 'Wet Hulled', 'Decaf']
+ROASTERS = [
+    'Northside', 'Little Owl', 'Foundry', 'Red Brick', 'Hatch', 'Atlas', 'Tidal', 'Kiln',
+    'Ember', 'Harbour', 'Oak & Iron', 'Copperline', 'Parlour', 'Old Mill', 'Stonefruit',
+    'Blue Door', 'Wildflower', 'Quarry', 'Lantern', 'Field Notes',
+]
+TASTE_WORDS = [
+    'chocolate', 'caramel', 'citrus', 'berry', 'floral', 'jasmine', 'bergamot', 'stone', 'fruit',
+    'nutty', 'hazelnut', 'almond', 'sweet', 'sour', 'bitter', 'astringent', 'balanced', 'bright',
+    'juicy', 'syrupy', 'thin', 'heavy', 'body', 'clean', 'muddy', 'finish', 'long', 'short',
+    'acidity', 'crema', 'thick', 'tiger', 'striping', 'channeling', 'fast', 'slow', 'shot',
+    'grind', 'finer', 'coarser', 'next', 'time', 'try', 'dose', 'up', 'down', 'great', 'good',
+    'okay', 'underextracted', 'overextracted', 'molasses', 'blueberry', 'lemon', 'peach',
+    'cocoa', 'brown', 'sugar', 'toffee', 'vanilla', 'honey', 'with', 'and', 'a', 'bit', 'too',
+    'very', 'milk', 'flat', 'white', 'cortado',
+]
+# Probability that an entry has no taste comment
+EMPTY_COMMENT_RATE = 0.25
+# Mean comment length in words (exponentially distributed, capped at 60)
+MEAN_COMMENT_WORDS = 8
+
+
+def _zipf_weights(n: int, exponent: float) -> List[float]:
+    """Cumulative weights where item k is picked with probability ~ 1 / (k + 1) ** exponent."""
+    return list(itertools.accumulate(1 / (k + 1) ** exponent for k in range(n)))
+
+
+def default_users(entries: int) -> int:
+    return max(10, entries // 100)
+
+
+def generate(path: str, entries: int, users: Optional[int] = None, seed: int = DEFAULT_SEED):
+    """Create a database at path with users and entries drawn from realistic distributions.
+
+    Coffee popularity and user activity are Zipf-like, grinder settings vary
+    around a per-coffee setting, weights around an 18g dose and 1:2.1 ratio,
+    and comment lengths are exponential with a share of empty comments.
+    The same arguments always produce the same rows.
+    """
+    users = users or default_users(entries)
+    rng = random.Random(seed)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    database.apply_pragmas(conn)
+    migrations.upgrade(conn)
+
+    password_hash = passwords.hash_password(BENCHMARK_PASSWORD)
+    conn.executemany('INSERT INTO user (email, password_hash, created_at) VALUES (?, ?, ?)',
+                     ((f'user{n}@example.com', password_hash, '2022-01-01 00:00:00')
+                      for n in range(1, users + 1)))
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM user ORDER BY id')]
+
+    coffee_names = [f'{roaster} {origin} {process}' for roaster in ROASTERS
+                    for origin in ORIGINS for process in PROCESSES]
+    rng.shuffle(coffee_names)
+    coffee_names = coffee_names[:max(20, min(len(coffee_names), entries // 500))]
+    conn.executemany('INSERT INTO coffee (name) VALUES (?)', ((name,) for name in coffee_names))
+    coffee_ids = [row[0] for row in conn.execute('SELECT id FROM coffee ORDER BY id')]
+    grind_base = {coffee_id: rng.uniform(8, 20) for coffee_id in coffee_ids}
+    conn.commit()
+
+    coffee_weights = _zipf_weights(len(coffee_ids), 1.1)
+    user_weights = _zipf_weights(len(user_ids), 0.8)
+    # Entries spread over three years, oldest first
+    created_at = datetime(2022, 1, 1)
+    mean_gap = 3 * 365 * 86400 / entries
+
+    def rows(count):
+        nonlocal created_at
+        for _ in range(count):
+            coffee_id = rng.choices(coffee_ids, cum_weights=coffee_weights)[0]
+            input_weight = round(min(max(rng.gauss(18, 0.8), 14), 22), 1)
+            ratio = min(max(rng.gauss(2.1, 0.3), 1.2), 3.5)
+            if rng.random() < EMPTY_COMMENT_RATE:
+                comment = ''
+            else:
+                words = min(60, 1 + int(rng.expovariate(1 / MEAN_COMMENT_WORDS)))
+                comment = ' '.join(rng.choices(TASTE_WORDS, k=words)).capitalize()
+            created_at += timedelta(seconds=rng.expovariate(1 / mean_gap))
+            timestamp = created_at.strftime('%Y-%m-%d %H:%M:%S')
+            yield (rng.choices(user_ids, cum_weights=user_weights)[0], coffee_id,
+                   f'{round((grind_base[coffee_id] + rng.gauss(0, 1)) * 2) / 2:g}',
+                   input_weight, round(input_weight * ratio, 1), comment,
+                   timestamp, timestamp + '.000')
+
+    for start in range(0, entries, GENERATE_BATCH_SIZE):
+        conn.executemany('''
+            INSERT INTO espresso_entry (user_id, coffee_id, grinder_setting, input_weight,
+                                        output_weight, taste_comment, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows(min(GENERATE_BATCH_SIZE, entries - start)))
+        conn.commit()
+
+    database.rebuild_coffee_stats(conn)
+    conn.commit()
+    conn.execute('PRAGMA optimize')
+    conn.close()
+
+
+class Workload:
+    """Sample rows the benchmarks operate on, picked from the generated data."""
+
+    def __init__(self, app_module):
+        self.app = app_module.app
+        with database.connection() as conn:
+            self.user_id, self.user_entries = conn.execute('''
+                SELECT user_id, COUNT(*) FROM espresso_entry
+                GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1
+            ''').fetchone()
+            self.email = conn.execute('SELECT email FROM user WHERE id = ?',
+                                      (self.user_id,)).fetchone()[0]
+            self.coffee, self.coffee_id = conn.execute(
+                'SELECT name, id FROM coffee ORDER BY entry_count DESC LIMIT 1'
+            ).fetchone()
+            self.entry_id = conn.execute(
+                'SELECT MAX(id) FROM espresso_entry WHERE user_id = ?', (self.user_id,)
+            ).fetchone()[0]
+        self.entry = database.get_entry_by_id(self.entry_id)
+        self.page = database.get_all_entries(limit=app_module.PAGE_SIZE)
+        self.cursor = database.make_cursor(self.page[-1])
+        self.search_term = 'chocolate'
+        self.added_ids: List[int] = []
+        self.email_ids: List[int] = []
+        # Due emails for claim_due_emails and the mark_email_* benchmarks
+        for _ in range(OUTBOX_EMAILS):
+            database.enqueue_email('user1@example.com', 'Benchmark', 'Hello', 0)
+        self.counter = itertools.count()
+
+        self.client = self.app.test_client()
+        self.user_client = self.app.test_client()
+        with self.user_client.session_transaction() as session:
+            session['_user_id'] = str(self.user_id)
+            session['_fresh'] = True
+
+
+# Benchmarks: group -> {name: function(workload)}
+BENCHMARKS: Dict[str, Dict[str, Callable]] = {'database': {}, 'routes': {}}
+
+# Public database.py functions that are connection plumbing, not operations
+NOT_TIMED = {
+    'get_db', 'apply_pragmas', 'verify_pragmas', 'get_pool', 'get_request_db',
+    'close_request_db', 'init_app', 'connection', 'begin_immediate', 'add_change_listener',
+    'add_user_listener', 'query_stats',
+}
+
+
+def benchmark(group: str, name: Optional[str] = None,
+              setup: Optional[Callable] = None):
+    """Register a benchmark; setup(workload), if given, runs untimed before each call."""
+    def register(func):
+        func.setup = setup
+        BENCHMARKS[group][name or func.__name__] = func
+        return func
+    return register
+
+
+@benchmark('database')
+def get_all_entries(w):
+    database.get_all_entries(limit=len(w.page))
+
+
+@benchmark('database', 'get_all_entries_next_page')
+def get_all_entries_next_page(w):
+    database.get_all_entries(user_id=w.user_id, scope='community', limit=len(w.page),
+                             cursor=(w.page[-1]['created_at'], w.page[-1]['id']))
+
+
+@benchmark('database')
+def get_entry_by_id(w):
+    database.get_entry_by_id(w.entry_id)
+
+
+@benchmark('database')
+def get_entries_by_coffee(w):
+    database.get_entries_by_coffee(w.coffee)
+
+
+@benchmark('database')
+def get_user_entries(w):
+    database.get_user_entries(w.user_id)
+
+
+@benchmark('database')
+def iter_user_entries(w):
+    for _ in database.iter_user_entries(w.user_id):
+        pass
+
+
+@benchmark('database')
+def get_anonymous_entries_by_coffee(w):
+    database.get_anonymous_entries_by_coffee(w.coffee, w.user_id)
+
+
+@benchmark('database')
+def get_user_and_anonymous_entries_by_coffee(w):
+    database.get_user_and_anonymous_entries_by_coffee(w.coffee, w.user_id)
+
+
+@benchmark('database')
+def get_all_coffees(w):
+    database.get_all_coffees()
+
+
+@benchmark('database')
+def get_or_create_coffee_id(w):
+    database.get_or_create_coffee_id(w.coffee)
+
+
+@benchmark('database')
+def get_entry_version(w):
+    database.get_entry_version(w.entry_id)
+
+
+@benchmark('database')
+def get_coffee_version(w):
+    database.get_coffee_version(w.coffee)
+
+
+@benchmark('database')
+def get_entries_version(w):
+    database.get_entries_version()
+
+
+@benchmark('database')
+def search_entries(w):
+    database.search_entries(w.search_term)
+
+
+@benchmark('database')
+def get_coffee_stats(w):
+    database.get_coffee_stats(w.coffee)
+
+
+@benchmark('database')
+def update_coffee_stats(w):
+    with database.connection() as conn:
+        database.update_coffee_stats(w.coffee_id, added=[w.entry], conn=conn)
+        conn.rollback()
+
+
+@benchmark('database')
+def rebuild_coffee_stats(w):
+    database.rebuild_coffee_stats()
+
+
+@benchmark('database')
+def calculate_extraction_ratio(w):
+    database.calculate_extraction_ratio(18.0, 36.5)
+
+
+@benchmark('database')
+def make_cursor(w):
+    database.make_cursor(w.entry)
+
+
+@benchmark('database')
+def parse_cursor(w):
+    database.parse_cursor(w.cursor)
+
+
+@benchmark('database')
+def add_entry(w):
+    w.added_ids.append(database.add_entry(w.user_id, w.coffee, '12', 18.0, 37.5,
+                                          'Benchmark shot, sweet and balanced'))
+
+
+@benchmark('database')
+def update_entry(w):
+    database.update_entry(w.entry_id, w.user_id, w.coffee, w.entry['grinder_setting'],
+                          w.entry['input_weight'], w.entry['output_weight'],
+                          f'Updated {next(w.counter)}')
+
+
+def _ensure_added(w):
+    # Measured alone (e.g. when confirming a regression), there's no add_entry
+    # run to delete after
+    if not w.added_ids:
+        add_entry(w)
+
+
+@benchmark('database', setup=_ensure_added)
+def delete_entry(w):
+    database.delete_entry(w.added_ids.pop(), w.user_id)
+
+
+@benchmark('database')
+def notify_entries_changed(w):
+    database.notify_entries_changed([w.coffee_id])
+
+
+@benchmark('database')
+def poll_changes(w):
+    database.poll_changes()
+
+
+@benchmark('database')
+def rename_coffee(w):
+    database.rename_coffee(w.coffee, w.coffee + ' (renamed)')
+    database.rename_coffee(w.coffee + ' (renamed)', w.coffee)
+
+
+@benchmark('database')
+def get_user_by_email(w):
+    database.get_user_by_email(w.email)
+
+
+@benchmark('database')
+def get_user_by_id(w):
+    database.get_user_by_id(w.user_id)
+
+
+@benchmark('database')
+def get_user_profile(w):
+    database.get_user_profile(w.user_id)
+
+
+@benchmark('database')
+def create_user(w):
+    database.create_user(f'new{next(w.counter)}@example.com', BENCHMARK_PASSWORD)
+
+
+@benchmark('database')
+def verify_password(w):
+    database.verify_password(database.get_user_by_id(w.user_id), BENCHMARK_PASSWORD)
+
+
+@benchmark('database')
+def update_user_password(w):
+    database.update_user_password(w.user_id, BENCHMARK_PASSWORD)
+
+
+@benchmark('database')
+def take_bucket_token(w):
+    database.take_bucket_token(f'ip:{next(w.counter) % 1000}', 20, 1 / 6, time.time())
+
+
+@benchmark('database')
+def prune_buckets(w):
+    database.prune_buckets(time.time() - 120)
+
+
+@benchmark('database')
+def enqueue_email(w):
+    database.enqueue_email('user1@example.com', 'Benchmark', 'Hello', 0)
+
+
+@benchmark('database')
+def claim_due_emails(w):
+    w.email_ids.extend(email['id'] for email in database.claim_due_emails(time.time(), 300, 10))
+
+
+def _ensure_claimed(w):
+    # claim_due_emails may have claimed every queued email already
+    if not w.email_ids:
+        database.enqueue_email('user1@example.com', 'Benchmark', 'Hello', 0)
+        claim_due_emails(w)
+
+
+@benchmark('database', setup=_ensure_claimed)
+def mark_email_sent(w):
+    database.mark_email_sent(w.email_ids.pop())
+
+
+@benchmark('database', setup=_ensure_claimed)
+def mark_email_failed(w):
+    database.mark_email_failed(w.email_ids.pop(), 'Benchmark failure', None)
+
+
+def _get(client, url: str, status: int = 200):
+    response = client.get(url)
+    response.get_data()
+    if response.status_code != status:
+        raise RuntimeError(f'GET {url} returned {response.status_code}')
+
+
+@benchmark('routes')
+def index(w):
+    _get(w.client, '/')
+
+
+@benchmark('routes', 'index_logged_in')
+def index_logged_in(w):
+    _get(w.user_client, '/')
+
+
+@benchmark('routes')
+def entries_feed(w):
+    _get(w.client, f'/entries/feed?feed=community&cursor={w.cursor}')
+
+
+@benchmark('routes', 'search')
+def search_route(w):
+    _get(w.client, f'/search?q={w.search_term}')
+
+
+@benchmark('routes', 'view_entry')
+def view_entry_route(w):
+    _get(w.client, f'/entry/{w.entry_id}')
+
+
+@benchmark('routes', 'coffee_view')
+def coffee_view_route(w):
+    _get(w.user_client, f'/coffee/{w.coffee}')
+
+
+@benchmark('routes', 'add_entry')
+def add_entry_route(w):
+    response = w.user_client.post('/add', data={
+        'coffee': w.coffee, 'grinder_setting': '12', 'input_weight': '18',
+        'output_weight': '37.5', 'taste_comment': 'Benchmark shot',
+    })
+    if response.status_code != 302:
+        raise RuntimeError(f'POST /add returned {response.status_code}')
+
+
+@benchmark('routes', 'export_csv')
+def export_csv_route(w):
+    _get(w.user_client, '/export.csv')
+
+
+@benchmark('routes', 'api_list_entries')
+def api_list_entries_route(w):
+    _get(w.client, '/api/v1/entries')
+
+
+@benchmark('routes', 'api_get_entry')
+def api_get_entry_route(w):
+    _get(w.client, f'/api/v1/entries/{w.entry_id}')
+
+
+@benchmark('routes', 'api_list_coffees')
+def api_list_coffees_route(w):
+    _get(w.client, '/api/v1/coffees')
+
+
+def untimed_functions() -> List[str]:
+    """Public database.py functions with no benchmark, to keep the suite complete."""
+    public = {name for name, func in inspect.getmembers(database, inspect.isfunction)
+              if not name.startswith('_') and func.__module__ == database.__name__}
+    return sorted(public - NOT_TIMED - set(BENCHMARKS['database']))
+
+
+def time_call(func: Callable, repeat: int = REPEAT, max_seconds: float = MAX_SECONDS,
+              setup: Optional[Callable] = None) -> Dict:
+    """Call func repeatedly and summarize the durations in milliseconds.
+    setup, if given, runs before each call without being timed.
+    """
+    if setup:
+        setup()
+    func()  # warm up
+    durations = []
+    deadline = time.perf_counter() + max_seconds
+    while len(durations) < MIN_CALLS or (len(durations) < repeat
+                                         and time.perf_counter() < deadline):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+    durations.sort()
+    mean = statistics.fmean(durations)
+    return {
+        'calls': len(durations),
+        'mean_ms': round(mean, 4),
+        'median_ms': round(statistics.median(durations), 4),
+        'p95_ms': round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 4),
+        'min_ms': round(durations[0], 4),
+        'ops_per_second': round(1000 / mean, 2) if mean else None,
+    }
+
+
+def _calibration_workload() -> Callable:
+    """A fixed workload independent of the code under test: queries and writes
+    on an in-memory SQLite table through the sqlite3 module.
+    """
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('CREATE TABLE item (id INTEGER PRIMARY KEY, grp INTEGER, name TEXT)')
+    conn.execute('CREATE INDEX idx_item_grp ON item(grp)')
+    conn.executemany('INSERT INTO item (grp, name) VALUES (?, ?)',
+                     ((n % 50, f'item {n}') for n in range(5000)))
+    conn.commit()
+    counter = itertools.count()
+
+    def work():
+        n = next(counter)
+        [dict(row) for row in conn.execute('SELECT * FROM item WHERE grp = ? ORDER BY name',
+                                           (n % 50,))]
+        conn.execute('UPDATE item SET name = ? WHERE id = ?', (f'renamed {n}', n % 5000 + 1))
+        conn.commit()
+    return work
+
+
+def calibrate(repeat: int = REPEAT, max_seconds: float = MAX_SECONDS) -> float:
+    """GATE_STAT time of the calibration workload: how fast the machine runs now."""
+    return time_call(_calibration_workload(), repeat, max_seconds)[GATE_STAT]
+
+
+def measure(path: str, repeat: int = REPEAT, max_seconds: float = MAX_SECONDS,
+            only: Optional[List[str]] = None) -> Dict:
+    """Time every benchmark against the database at path. Must run in a fresh
+    process: the app reads its configuration when imported.
+    """
+    os.environ['DATABASE_PATH'] = path
+    os.environ['PAGE_CACHE_TTL'] = '0'
+    # Leave the queued benchmark emails alone
+    os.environ['EMAIL_SENDER'] = 'worker'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    database.DATABASE = path
+    import app as app_module
+
+    workload = Workload(app_module)
+    results = {'user_entries': workload.user_entries}
+    calibration = calibrate(repeat, max_seconds)
+    for group, benchmarks in BENCHMARKS.items():
+        results[group] = {}
+        for name, func in benchmarks.items():
+            if only and name not in only:
+                continue
+            # Direct database calls share one app context, like the calls in a request.
+            # Route benchmarks push none, so each test-client request gets its own
+            # context, pooled connection and query stats, as it would when served.
+            context = workload.app.app_context() if group == 'database' else nullcontext()
+            with context:
+                setup = func.setup and (lambda: func.setup(workload))
+                results[group][name] = time_call(lambda: func(workload), repeat, max_seconds,
+                                                 setup)
+            print(f'{group}.{name}: {results[group][name]["median_ms"]:.3f} ms',
+                  file=sys.stderr)
+    # Calibrated before and after, keeping the faster
+    results['calibration_ms'] = min(calibration, calibrate(repeat, max_seconds))
+    return results
+
+
+def run(sizes=DEFAULT_SIZES, data_dir: str = DATA_DIR, seed: int = DEFAULT_SEED,
+        repeat: int = REPEAT, max_seconds: float = MAX_SECONDS,
+        only: Optional[List[str]] = None) -> Dict:
+    """Generate (or reuse) a database per size and measure each in a subprocess."""
+    os.makedirs(data_dir, exist_ok=True)
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'seed': seed,
+        'untimed': untimed_functions(),
+        'sizes': {},
+    }
+    for size in sizes:
+        source = os.path.join(data_dir, f'entries-{size}-seed-{seed}.db')
+        if not os.path.exists(source):
+            print(f'Generating {size} entries in {source}', file=sys.stderr)
+            start = time.perf_counter()
+            generate(source + '.tmp', size, seed=seed)
+            os.replace(source + '.tmp', source)
+            print(f'Generated in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+        working = os.path.join(data_dir, f'run-{size}.db')
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(working + suffix):
+                os.remove(working + suffix)
+        shutil.copyfile(source, working)
+        # Datasets generated before a schema change are measured on the current schema
+        conn = sqlite3.connect(working)
+        conn.row_factory = sqlite3.Row
+        migrations.upgrade(conn)
+        conn.close()
+        command = [sys.executable, os.path.abspath(__file__), 'measure', working,
+                   '--repeat', str(repeat), '--max-seconds', str(max_seconds)]
+        if only:
+            command += ['--only', *only]
+        print(f'Measuring {size} entries', file=sys.stderr)
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        report['sizes'][str(size)] = {'entries': size, 'users': default_users(size),
+                                      **json.loads(output)}
+    return report
+
+
+def machine_factor(measured: Dict, baseline: Dict, stats: Optional[Dict] = None) -> float:
+    """How much slower the machine ran for one size's results than for the
+    baseline's, from their calibration times (1 if either has none). stats can
+    carry its own calibration_ms, for an operation measured again on its own.
+    """
+    now = (stats or {}).get('calibration_ms') or measured.get('calibration_ms')
+    then = baseline.get('calibration_ms')
+    return now / then if now and then else 1.0
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = TOLERANCE) -> List[Dict]:
+    """Compare GATE_STAT times with the baseline's, scaled by machine_factor.
+    Returns one row per baseline operation with its change; rows with regressed
+    set are failures (including operations missing from results).
+    """
+    rows = []
+    for size, groups in baseline['sizes'].items():
+        measured = results['sizes'].get(size, {})
+        for group in BENCHMARKS:
+            for name, stats in groups.get(group, {}).items():
+                current = measured.get(group, {}).get(name)
+                factor = machine_factor(measured, groups, current)
+                before = stats[GATE_STAT] * factor
+                after = current[GATE_STAT] if current else None
+                rows.append({
+                    'size': size, 'operation': f'{group}.{name}',
+                    'baseline_ms': before, 'current_ms': after, 'machine_factor': factor,
+                    'change': after / before - 1 if after is not None and before else None,
+                    'regressed': after is None or (after > before * (1 + tolerance)
+                                                   and after - before > MIN_REGRESSION_MS),
+                })
+    return rows
+
+
+def _tracked_names() -> List[str]:
+    return sorted({name for names in TRACKED.values() for name in names})
+
+
+def _only_tracked(report: Dict) -> Dict:
+    for groups in report['sizes'].values():
+        for group, names in TRACKED.items():
+            groups[group] = {name: stats for name, stats in groups[group].items()
+                             if name in names}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser('generate', help='create a synthetic database')
+    generate_parser.add_argument('path')
+    generate_parser.add_argument('--entries', type=int, default=DEFAULT_SIZES[0])
+    generate_parser.add_argument('--users', type=int)
+    generate_parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+
+    run_parser = commands.add_parser('run', help='benchmark at several sizes')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    run_parser.add_argument('--output', help='write JSON results here instead of stdout')
+
+    measure_parser = commands.add_parser('measure', help='benchmark one database (internal)')
+    measure_parser.add_argument('path')
+
+    compare_parser = commands.add_parser('compare', help='check for regressions against the baseline')
+    compare_parser.add_argument('--results', help='results of `run` (default: run the tracked benchmarks)')
+    compare_parser.add_argument('--baseline', default=BASELINE_PATH)
+    compare_parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                                help='allowed slowdown as a fraction of the baseline')
+    compare_parser.add_argument('--update', action='store_true',
+                                help='write the tracked results as the new baseline')
+
+    for sub in (run_parser, measure_parser, compare_parser):
+        sub.add_argument('--repeat', type=int, default=REPEAT)
+        sub.add_argument('--max-seconds', type=float, default=MAX_SECONDS)
+    for sub in (run_parser, measure_parser):
+        sub.add_argument('--only', nargs='+', help='run only these benchmarks')
+    for sub in (run_parser, compare_parser):
+        sub.add_argument('--data-dir', default=DATA_DIR)
+        sub.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        generate(args.path, args.entries, args.users, args.seed)
+    elif args.command == 'measure':
+        json.dump(measure(args.path, args.repeat, args.max_seconds, args.only), sys.stdout)
+    elif args.command == 'compare':
+        return compare_command(args)
+    else:
+        report = run(args.sizes, args.data_dir, args.seed, args.repeat, args.max_seconds,
+                     args.only)
+        if report['untimed']:
+            print(f'No benchmark for: {", ".join(report["untimed"])}', file=sys.stderr)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+                f.write('\n')
+        else:
+            json.dump(report, sys.stdout, indent=2)
+
+
+def compare_command(args) -> int:
+    if args.update:
+        report = _only_tracked(run(TRACKED_SIZES, args.data_dir, args.seed, args.repeat,
+                                   args.max_seconds, _tracked_names()))
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f'Wrote baseline to {args.baseline}')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if args.results:
+        with open(args.results) as f:
+            results = json.load(f)
+    else:
+        names = sorted({name for groups in baseline['sizes'].values()
+                        for group in groups.values() if isinstance(group, dict)
+                        for name in group})
+        results = run([int(size) for size in baseline['sizes']], args.data_dir, args.seed,
+                      args.repeat, args.max_seconds, names)
+
+    rows = compare(results, baseline, args.tolerance)
+    for _ in range(0 if args.results else CONFIRM_RUNS):
+        regressed = [row for row in rows if row['regressed'] and row['current_ms'] is not None]
+        if not regressed:
+            break
+        print(f'Measuring {len(regressed)} regressed operations again', file=sys.stderr)
+        rerun = run(sorted({int(row['size']) for row in regressed}), args.data_dir, args.seed,
+                    args.repeat, args.max_seconds,
+                    sorted({row['operation'].split('.', 1)[1] for row in regressed}))
+        for row in regressed:
+            group, name = row['operation'].split('.', 1)
+            measured, rerun_size = results['sizes'][row['size']], rerun['sizes'][row['size']]
+            again = dict(rerun_size[group][name], calibration_ms=rerun_size.get('calibration_ms'))
+
+            # Keep the faster run, relative to the machine's speed at the time
+            def scaled(stats):
+                return stats[GATE_STAT] / machine_factor(measured, baseline['sizes'][row['size']],
+                                                         stats)
+            if scaled(again) < scaled(measured[group][name]):
+                measured[group][name] = again
+        rows = compare(results, baseline, args.tolerance)
+    for row in rows:
+        if row['current_ms'] is None:
+            print(f"FAIL {row['size']:>8} {row['operation']:<40} missing from results")
+            continue
+        status = 'FAIL' if row['regressed'] else 'OK  '
+        print(f"{status} {row['size']:>8} {row['operation']:<40} {row['baseline_ms']:10.3f} ms"
+              f" -> {row['current_ms']:10.3f} ms ({row['change']:+.0%},"
+              f" machine {row['machine_factor']:.2f}x)")
+    regressions = [row for row in rows if row['regressed']]
+    if regressions:
+        print(f'{len(regressions)} of {len(rows)} tracked operations regressed by more than '
+              f'{args.tolerance:.0%}')
+        return 1
+    print(f'No regressions in {len(rows)} tracked operations')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set
+
+
+class PageCache:
+    """In-process LRU cache with a TTL and tag-based invalidation.
+
+    Each value is stored with a set of tags; ``invalidate(tag)`` drops every
+    value carrying that tag. At most ``max_entries`` values are kept, evicting
+    the least recently used. A ``ttl`` of 0 disables the cache.
+    """
+
+    def __init__(self, max_entries: int = 500, ttl: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self._tags: Dict[str, Set[Hashable]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for key, or None if missing or expired."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = ()):
+        """Store value under key, evicting the least recently used if full."""
+        if not self.enabled:
+            return
+        tags = frozenset(tags)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_key(self, key: Hashable):
+        """Drop the value stored under key."""
+        with self._lock:
+            self._remove(key)
+
+    def invalidate(self, tag: str):
+        """Drop every value stored with tag."""
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: Hashable):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        for tag in item[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
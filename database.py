@@ -1,242 +1,899 @@
+import base64
+import logging
+import math
+import os
+import queue
+import re
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
-from werkzeug.security import generate_password_hash, check_password_hash
+from typing import Dict, Iterator, List, Optional, Tuple
+from flask import g, has_app_context
 
+import passwords
+from querystats import InstrumentedConnection, QueryStats
 
-DATABASE = 'espresso_tracker.db'
+
+DATABASE = os.environ.get('DATABASE_PATH', 'espresso_tracker.db')
+
+logger = logging.getLogger(__name__)
+
+# PRAGMA profile applied to every new connection
+PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -16000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 128 * 1024 * 1024)),
+    'temp_store': os.environ.get('SQLITE_TEMP_STORE', 'MEMORY'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+}
+
+# Numeric values SQLite reports back for the named PRAGMA settings
+_PRAGMA_NAMES = {
+    'synchronous': {'OFF': 0, 'NORMAL': 1, 'FULL': 2, 'EXTRA': 3},
+    'temp_store': {'DEFAULT': 0, 'FILE': 1, 'MEMORY': 2},
+}
+
+# Connection pool settings (per worker process)
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+
+
+def query_stats() -> Optional[QueryStats]:
+    """The current request's QueryStats, or None if it hasn't used the database."""
+    return g.get('query_stats') if has_app_context() else None
 
 
 def get_db():
-    """Get database connection."""
-    conn = sqlite3.connect(DATABASE)
+    """Open a new database connection."""
+    conn = sqlite3.connect(DATABASE, check_same_thread=False, factory=InstrumentedConnection)
     conn.row_factory = sqlite3.Row
+    apply_pragmas(conn)
     return conn
 
 
-def init_db():
-    """Initialize the database and create tables if they don't exist."""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Create user table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create espresso_entry table (check if user_id column exists)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS espresso_entry (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            coffee TEXT NOT NULL,
-            grinder_setting TEXT NOT NULL,
-            input_weight REAL NOT NULL,
-            output_weight REAL NOT NULL,
-            taste_comment TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES user(id)
-        )
-    ''')
-    
-    # Migration: Add user_id column if it doesn't exist (for existing databases)
+def apply_pragmas(conn: sqlite3.Connection, pragmas: Optional[Dict] = None):
+    """Apply the connection PRAGMA profile."""
+    for name, value in (pragmas or PRAGMAS).items():
+        conn.execute(f'PRAGMA {name} = {value}')
+
+
+def verify_pragmas(conn: sqlite3.Connection, pragmas: Optional[Dict] = None) -> Dict:
+    """Compare a connection's settings with the PRAGMA profile.
+    Returns {name: (expected, actual)} for every setting that differs.
+    """
+    mismatches = {}
+    for name, expected in (pragmas or PRAGMAS).items():
+        actual = conn.execute(f'PRAGMA {name}').fetchone()[0]
+        if isinstance(expected, str):
+            expected = _PRAGMA_NAMES.get(name, {}).get(expected.upper(), expected)
+        if isinstance(actual, str) and isinstance(expected, str):
+            matches = actual.lower() == expected.lower()
+        else:
+            matches = actual == expected
+        if not matches:
+            mismatches[name] = (expected, actual)
+    return mismatches
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections owned by one worker process.
+
+    At most ``max_size`` connections are checked out at once; idle ones are
+    kept for reuse instead of being reopened on every call.
+    """
+
+    def __init__(self, max_size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue(maxsize=max_size)
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def acquire(self) -> sqlite3.Connection:
+        """Check out a connection, opening a new one if none are idle."""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RuntimeError('Timed out waiting for a database connection')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                return get_db()
+            except Exception:
+                self._slots.release()
+                raise
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection to the pool, discarding any open transaction."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        """Close every idle connection."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Get this process's connection pool, creating it after a fork."""
+    global _pool
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool()
+    return _pool
+
+
+def get_request_db() -> sqlite3.Connection:
+    """Get the connection shared by the current request."""
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+        g.db.stats = g.query_stats = QueryStats()
+    return g.db
+
+
+def close_request_db(exc=None):
+    """Return the request's connection to the pool."""
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.stats = None
+        get_pool().release(conn)
+
+
+def init_app(app):
+    """Register request-scoped connection handling on a Flask app."""
+    app.teardown_appcontext(close_request_db)
+
+
+@contextmanager
+def connection(conn: Optional[sqlite3.Connection] = None):
+    """Yield the connection to run on.
+
+    Uses ``conn`` if given, else the request's shared connection inside an
+    app context, else a connection borrowed from the pool for this call.
+    """
+    if conn is None and has_app_context():
+        conn = get_request_db()
+    if conn is not None:
+        try:
+            yield conn
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        return
+
+    pool = get_pool()
+    conn = pool.acquire()
     try:
-        cursor.execute('SELECT user_id FROM espresso_entry LIMIT 1')
-    except sqlite3.OperationalError:
-        # Column doesn't exist, need to migrate
-        # Create a default anonymous user for existing entries
-        cursor.execute('''
-            INSERT OR IGNORE INTO user (id, email, password_hash)
-            VALUES (1, 'anonymous@system.local', ?)
-        ''', (generate_password_hash('migration'),))
-        
-        # Add user_id column with default value
-        cursor.execute('ALTER TABLE espresso_entry ADD COLUMN user_id INTEGER DEFAULT 1')
-        cursor.execute('UPDATE espresso_entry SET user_id = 1 WHERE user_id IS NULL')
-        
-        # Make user_id NOT NULL
-        # SQLite doesn't support ALTER COLUMN, so we need to recreate the table
-        cursor.execute('''
-            CREATE TABLE espresso_entry_new (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                coffee TEXT NOT NULL,
-                grinder_setting TEXT NOT NULL,
-                input_weight REAL NOT NULL,
-                output_weight REAL NOT NULL,
-                taste_comment TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES user(id)
-            )
-        ''')
-        cursor.execute('''
-            INSERT INTO espresso_entry_new 
-            SELECT id, COALESCE(user_id, 1), coffee, grinder_setting, input_weight, 
-                   output_weight, taste_comment, created_at
-            FROM espresso_entry
-        ''')
-        cursor.execute('DROP TABLE espresso_entry')
-        cursor.execute('ALTER TABLE espresso_entry_new RENAME TO espresso_entry')
-    
-    # Create indexes for performance
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_espresso_entry_user_id ON espresso_entry(user_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_espresso_entry_coffee ON espresso_entry(coffee)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_email ON user(email)')
-    
-    conn.commit()
-    conn.close()
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def begin_immediate(conn: sqlite3.Connection):
+    """Start a write transaction on conn. Raises RuntimeError if one is already
+    open: committing it first would commit the caller's unfinished work.
+    """
+    if conn.in_transaction:
+        raise RuntimeError('A transaction is already open on this connection')
+    conn.execute('BEGIN IMMEDIATE')
+
+
+# Change listeners: called after a committed write with the names of the coffees
+# whose entries changed and whether the coffee list itself may have changed
+_change_listeners = []
+
+
+def add_change_listener(listener):
+    """Register listener(coffee_names, catalog_changed) to be called after entry writes."""
+    _change_listeners.append(listener)
+
+
+def _notify_change(coffee_names, catalog_changed: bool):
+    for listener in _change_listeners:
+        try:
+            listener(set(coffee_names), catalog_changed)
+        except Exception:
+            logger.exception('Change listener failed')
+
+
+def notify_entries_changed(coffee_ids, conn: Optional[sqlite3.Connection] = None):
+    """Tell the change listeners that entries of these coffees were committed.
+    A coffee left with zero or one entries may have just left or joined the coffee list.
+    """
+    if not _change_listeners:
+        return
+    names, catalog_changed = set(), False
+    with connection(conn) as conn:
+        for coffee_id in set(coffee_ids):
+            row = conn.execute('SELECT name, entry_count FROM coffee WHERE id = ?',
+                               (coffee_id,)).fetchone()
+            if row:
+                names.add(row['name'])
+                catalog_changed = catalog_changed or row['entry_count'] <= 1
+    _notify_change(names, catalog_changed)
+
+
+# Last (seq, catalog_seq) of change_counter handled by this process
+_seen_changes = None
+_seen_changes_lock = threading.Lock()
+
+
+def poll_changes(conn: Optional[sqlite3.Connection] = None):
+    """Notify the change listeners of writes committed by any process since the last poll.
+    Costs one primary key lookup when nothing changed. The first poll only
+    records the current position.
+    """
+    global _seen_changes
+    with connection(conn) as conn:
+        current = tuple(conn.execute(
+            'SELECT seq, catalog_seq FROM change_counter WHERE id = 1'
+        ).fetchone())
+        with _seen_changes_lock:
+            seen, _seen_changes = _seen_changes, current
+            if seen is None or seen == current:
+                return
+            names = [row['name'] for row in conn.execute(
+                'SELECT name FROM coffee WHERE change_seq > ?', (seen[0],)
+            )]
+    _notify_change(names, catalog_changed=current[1] != seen[1])
 
 
 def add_entry(user_id: int, coffee: str, grinder_setting: str, input_weight: float, 
-              output_weight: float, taste_comment: str = '') -> int:
+              output_weight: float, taste_comment: str = '',
+              conn: Optional[sqlite3.Connection] = None) -> int:
     """Add a new espresso entry to the database."""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO espresso_entry (user_id, coffee, grinder_setting, input_weight, 
-                                   output_weight, taste_comment)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, coffee, grinder_setting, input_weight, output_weight, taste_comment))
-    
-    entry_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return entry_id
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        coffee_id = get_or_create_coffee_id(coffee, conn=conn)
+        
+        cursor.execute('''
+            INSERT INTO espresso_entry (user_id, coffee_id, grinder_setting, input_weight, 
+                                       output_weight, taste_comment)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, coffee_id, grinder_setting, input_weight, output_weight, taste_comment))
+        
+        entry_id = cursor.lastrowid
+        update_coffee_stats(coffee_id, added=[_get_stats_row(cursor, entry_id)], conn=conn)
+        conn.commit()
+        notify_entries_changed([coffee_id], conn=conn)
+        return entry_id
 
 
-def get_all_entries(user_id: Optional[int] = None) -> List[Dict]:
-    """Get all entries ordered by creation date (newest first).
-    If user_id is provided, returns user's entries + anonymous community entries.
+# Control characters marking matches in search snippets; the text around them
+# is escaped before they are turned into <mark> tags
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+# Entry fields that can be projected, mapped to their SQL expressions. The
+# default column list (fields=None) is every entry column plus coffee and user_email.
+ENTRY_FIELDS = {
+    'id': 'e.id',
+    'coffee': 'c.name',
+    'grinder_setting': 'e.grinder_setting',
+    'input_weight': 'e.input_weight',
+    'output_weight': 'e.output_weight',
+    'extraction_ratio': 'e.extraction_ratio',
+    'taste_comment': 'e.taste_comment',
+    'created_at': 'e.created_at',
+}
+_DEFAULT_COLUMNS = 'e.*, c.name as coffee, u.email as user_email'
+
+
+def _select_columns(fields: Optional[List[str]], required: Tuple[str, ...] = ('id',)) -> str:
+    """Build a SELECT column list for the given entry fields.
+    Raises ValueError for a field not in ENTRY_FIELDS.
     """
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    if user_id:
-        # Get user's entries + anonymous entries from others
-        cursor.execute('''
-            SELECT e.*, u.email as user_email
-            FROM espresso_entry e
-            LEFT JOIN user u ON e.user_id = u.id
-            WHERE e.user_id = ? OR e.user_id != ?
-            ORDER BY e.created_at DESC
-        ''', (user_id, user_id))
-    else:
-        # Get all entries (for unauthenticated users)
-        cursor.execute('''
-            SELECT e.*, u.email as user_email
-            FROM espresso_entry e
-            LEFT JOIN user u ON e.user_id = u.id
-            ORDER BY e.created_at DESC
-        ''')
-    
-    entries = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return entries
+    if fields is None:
+        return _DEFAULT_COLUMNS
+    unknown = [field for field in fields if field not in ENTRY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown field: {', '.join(unknown)}")
+    names = list(required) + [field for field in fields if field not in required]
+    return ', '.join(f'{ENTRY_FIELDS[name]} AS {name}' for name in names)
+
 
+# Cursor that sorts after every real (created_at, id) pair
+_FIRST_PAGE = ('9999-12-31 23:59:59', 2 ** 63 - 1)
 
-def get_entry_by_id(entry_id: int) -> Optional[Dict]:
-    """Get a single entry by ID."""
-    conn = get_db()
-    cursor = conn.cursor()
+
+def get_all_entries(user_id: Optional[int] = None, scope: Optional[str] = None,
+                    cursor: Optional[Tuple[str, int]] = None, limit: Optional[int] = None,
+                    fields: Optional[List[str]] = None,
+                    conn: Optional[sqlite3.Connection] = None) -> List[Dict]:
+    """Get entries ordered by creation date (newest first).
+    If user_id is provided, returns user's entries + anonymous community entries;
+    scope='user' or scope='community' narrows that to one of the two.
+    Pass the (created_at, id) of the last row seen as cursor to fetch the next page.
+    fields selects only those ENTRY_FIELDS (plus id and created_at) instead of every column.
+    """
+    # Keyset pagination: rows strictly after the cursor in (created_at, id) order.
+    # The first page uses an open-ended cursor so every query is an index range scan.
+    created_at, entry_id = cursor or _FIRST_PAGE
+    limit = limit or -1
+    columns = _select_columns(fields, ('id', 'created_at'))
     
-    cursor.execute('SELECT * FROM espresso_entry WHERE id = ?', (entry_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        if user_id and scope == 'user':
+            cursor.execute('''
+                SELECT {columns}
+                FROM espresso_entry e
+                JOIN coffee c ON c.id = e.coffee_id
+                LEFT JOIN user u ON e.user_id = u.id
+                WHERE e.user_id = ? AND (e.created_at, e.id) < (?, ?)
+                ORDER BY e.created_at DESC, e.id DESC
+                LIMIT ?
+            '''.format(columns=columns), (user_id, created_at, entry_id, limit))
+        elif user_id and scope == 'community':
+            cursor.execute('''
+                SELECT {columns}
+                FROM espresso_entry e
+                JOIN coffee c ON c.id = e.coffee_id
+                LEFT JOIN user u ON e.user_id = u.id
+                WHERE e.user_id != ? AND (e.created_at, e.id) < (?, ?)
+                ORDER BY e.created_at DESC, e.id DESC
+                LIMIT ?
+            '''.format(columns=columns), (user_id, created_at, entry_id, limit))
+        else:
+            # Get all entries (for unauthenticated users or an unscoped feed)
+            cursor.execute('''
+                SELECT {columns}
+                FROM espresso_entry e
+                JOIN coffee c ON c.id = e.coffee_id
+                LEFT JOIN user u ON e.user_id = u.id
+                WHERE (e.created_at, e.id) < (?, ?)
+                ORDER BY e.created_at DESC, e.id DESC
+                LIMIT ?
+            '''.format(columns=columns), (created_at, entry_id, limit))
+        
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def make_cursor(entry: Dict, key: str = 'created_at') -> str:
+    """Encode an entry's (key, id) position as an opaque page cursor."""
+    raw = f"{entry[key]}|{entry['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def parse_cursor(token: Optional[str], cast=str) -> Optional[Tuple]:
+    """Decode a page cursor into (key, id), converting key with cast.
+    Returns None if it is missing or malformed.
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        key, entry_id = raw.rsplit('|', 1)
+        return cast(key), int(entry_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def get_entry_by_id(entry_id: int, fields: Optional[List[str]] = None,
+                    conn: Optional[sqlite3.Connection] = None) -> Optional[Dict]:
+    """Get a single entry by ID, optionally only the given ENTRY_FIELDS."""
+    columns = 'e.*, c.name as coffee' if fields is None else _select_columns(fields)
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT {columns}
+            FROM espresso_entry e
+            JOIN coffee c ON c.id = e.coffee_id
+            WHERE e.id = ?
+        '''.format(columns=columns), (entry_id,))
+        row = cursor.fetchone()
     
     return dict(row) if row else None
 
 
-def get_entries_by_coffee(coffee_name: str, user_id: Optional[int] = None) -> List[Dict]:
+def get_entries_by_coffee(coffee_name: str, user_id: Optional[int] = None,
+                          conn: Optional[sqlite3.Connection] = None) -> List[Dict]:
     """Get all entries for a specific coffee.
     If user_id is provided, returns user's entries + anonymous community entries.
     """
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    if user_id:
-        # Get user's entries + anonymous entries from others
-        cursor.execute('''
-            SELECT e.*, u.email as user_email
-            FROM espresso_entry e
-            LEFT JOIN user u ON e.user_id = u.id
-            WHERE e.coffee = ? AND (e.user_id = ? OR e.user_id != ?)
-            ORDER BY e.created_at DESC
-        ''', (coffee_name, user_id, user_id))
-    else:
-        # Get all entries (for unauthenticated users)
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        if user_id:
+            # Get user's entries + anonymous entries from others
+            cursor.execute('''
+                SELECT e.*, c.name as coffee, u.email as user_email
+                FROM espresso_entry e
+                JOIN coffee c ON c.id = e.coffee_id
+                LEFT JOIN user u ON e.user_id = u.id
+                WHERE c.name = ? AND (e.user_id = ? OR e.user_id != ?)
+                ORDER BY e.created_at DESC
+            ''', (coffee_name, user_id, user_id))
+        else:
+            # Get all entries (for unauthenticated users)
+            cursor.execute('''
+                SELECT e.*, c.name as coffee, u.email as user_email
+                FROM espresso_entry e
+                JOIN coffee c ON c.id = e.coffee_id
+                LEFT JOIN user u ON e.user_id = u.id
+                WHERE c.name = ?
+                ORDER BY e.created_at DESC
+            ''', (coffee_name,))
+        
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def get_user_entries(user_id: int, conn: Optional[sqlite3.Connection] = None) -> List[Dict]:
+    """Get all entries for a specific user."""
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
         cursor.execute('''
-            SELECT e.*, u.email as user_email
+            SELECT e.*, c.name as coffee
             FROM espresso_entry e
-            LEFT JOIN user u ON e.user_id = u.id
-            WHERE e.coffee = ?
+            JOIN coffee c ON c.id = e.coffee_id
+            WHERE e.user_id = ?
             ORDER BY e.created_at DESC
-        ''', (coffee_name,))
-    
-    entries = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return entries
+        ''', (user_id,))
+        
+        return [dict(row) for row in cursor.fetchall()]
 
 
-def get_user_entries(user_id: int) -> List[Dict]:
-    """Get all entries for a specific user."""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT * FROM espresso_entry
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-    ''', (user_id,))
-    
-    entries = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return entries
+EXPORT_BATCH_SIZE = 500
+
+
+def iter_user_entries(user_id: int, batch_size: int = EXPORT_BATCH_SIZE,
+                      conn: Optional[sqlite3.Connection] = None) -> Iterator[sqlite3.Row]:
+    """Yield a user's entries oldest first, fetching batch_size rows at a time.
+    Unlike get_user_entries, only one batch is held in memory.
+    """
+    with connection(conn) as conn:
+        cursor = conn.execute('''
+            SELECT e.id, e.created_at, c.name as coffee, e.grinder_setting,
+                   e.input_weight, e.output_weight, e.extraction_ratio, e.taste_comment
+            FROM espresso_entry e
+            JOIN coffee c ON c.id = e.coffee_id
+            WHERE e.user_id = ?
+            ORDER BY e.created_at, e.id
+        ''', (user_id,))
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
 
 
-def get_anonymous_entries_by_coffee(coffee_name: str, exclude_user_id: int) -> List[Dict]:
+def get_anonymous_entries_by_coffee(coffee_name: str, exclude_user_id: int,
+                                    conn: Optional[sqlite3.Connection] = None) -> List[Dict]:
     """Get anonymous entries for a coffee, excluding the specified user's entries."""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT e.*
-        FROM espresso_entry e
-        WHERE e.coffee = ? AND e.user_id != ?
-        ORDER BY e.created_at DESC
-    ''', (coffee_name, exclude_user_id))
-    
-    entries = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return entries
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT e.*, c.name as coffee
+            FROM coffee c
+            JOIN espresso_entry e ON e.coffee_id = c.id
+            WHERE c.name = ? AND e.user_id != ?
+            ORDER BY e.created_at DESC
+        ''', (coffee_name, exclude_user_id))
+        
+        return [dict(row) for row in cursor.fetchall()]
 
 
-def get_user_and_anonymous_entries_by_coffee(coffee_name: str, user_id: int) -> tuple:
+def get_user_and_anonymous_entries_by_coffee(coffee_name: str, user_id: Optional[int],
+                                             min_ratio: Optional[float] = None,
+                                             max_ratio: Optional[float] = None,
+                                             sort: str = 'newest',
+                                             conn: Optional[sqlite3.Connection] = None) -> tuple:
     """Get user's entries and anonymous entries separately for a coffee.
+    Both partitions come from one query, tagged by ownership and split in a single pass.
+    Entries can be limited to an extraction ratio range and sorted by
+    'newest' (default) or 'ratio'. Without a user_id every entry is anonymous.
     Returns (user_entries, anonymous_entries)
     """
-    user_entries = get_user_entries(user_id)
-    user_entries = [e for e in user_entries if e['coffee'] == coffee_name]
+    # Open-ended bounds keep the ratio condition an index range
+    min_ratio = float('-inf') if min_ratio is None else min_ratio
+    max_ratio = float('inf') if max_ratio is None else max_ratio
+    
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        if sort == 'ratio':
+            cursor.execute('''
+                SELECT e.*, c.name as coffee, u.email as user_email, e.user_id = ? AS is_mine
+                FROM coffee c
+                JOIN espresso_entry e ON e.coffee_id = c.id
+                LEFT JOIN user u ON e.user_id = u.id
+                WHERE c.name = ? AND e.extraction_ratio BETWEEN ? AND ?
+                ORDER BY e.extraction_ratio, e.id
+            ''', (user_id, coffee_name, min_ratio, max_ratio))
+        else:
+            # Unary + keeps the planner on the (coffee_id, created_at) index so rows
+            # arrive in date order; the ratio range is applied as a filter
+            cursor.execute('''
+                SELECT e.*, c.name as coffee, u.email as user_email, e.user_id = ? AS is_mine
+                FROM coffee c
+                JOIN espresso_entry e ON e.coffee_id = c.id
+                LEFT JOIN user u ON e.user_id = u.id
+                WHERE c.name = ? AND +e.extraction_ratio BETWEEN ? AND ?
+                ORDER BY e.created_at DESC, e.id DESC
+            ''', (user_id, coffee_name, min_ratio, max_ratio))
+        rows = cursor.fetchall()
     
-    anonymous_entries = get_anonymous_entries_by_coffee(coffee_name, user_id)
+    user_entries = []
+    anonymous_entries = []
+    for row in rows:
+        entry = dict(row)
+        if entry.pop('is_mine'):
+            user_entries.append(entry)
+        else:
+            anonymous_entries.append(entry)
     
     return user_entries, anonymous_entries
 
 
-def get_all_coffees() -> List[str]:
-    """Get a list of all unique coffee names."""
-    conn = get_db()
-    cursor = conn.cursor()
+def get_all_coffees(conn: Optional[sqlite3.Connection] = None) -> List[str]:
+    """Get a list of all coffee names that have entries, from the coffee catalog."""
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        # The catalog holds one row per coffee, so reading all of it is intended
+        cursor.execute('''
+            SELECT name FROM coffee
+            WHERE entry_count > 0
+            ORDER BY name  -- advisor: allow-scan
+        ''')
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_or_create_coffee_id(name: str, conn: Optional[sqlite3.Connection] = None) -> int:
+    """Get the catalog id for a coffee name, adding the coffee if it is new.
+    Runs inside the caller's transaction when a connection is passed.
+    """
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT id FROM coffee WHERE name = ?', (name,))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+        
+        try:
+            cursor.execute('INSERT INTO coffee (name) VALUES (?)', (name,))
+            return cursor.lastrowid
+        except sqlite3.IntegrityError:
+            # Another worker added it since the lookup
+            cursor.execute('SELECT id FROM coffee WHERE name = ?', (name,))
+            return cursor.fetchone()[0]
+
+
+# Data versions: (entry count, last change) pairs used as HTTP cache validators.
+# The coffee catalog's updated_at covers additions, edits and deletions of its
+# entries, so no version query has to touch espresso_entry beyond one row.
+
+def get_entry_version(entry_id: int, conn: Optional[sqlite3.Connection] = None) -> Optional[Tuple[int, str]]:
+    """Version of a single entry page (the entry or its coffee changed). None if missing."""
+    with connection(conn) as conn:
+        row = conn.execute('''
+            SELECT 1, MAX(e.updated_at, c.updated_at)
+            FROM espresso_entry e
+            JOIN coffee c ON c.id = e.coffee_id
+            WHERE e.id = ?
+        ''', (entry_id,)).fetchone()
+    return tuple(row) if row else None
+
+
+def get_coffee_version(coffee_name: str, conn: Optional[sqlite3.Connection] = None) -> Optional[Tuple[int, str]]:
+    """Version of one coffee's entries. None if the coffee is unknown."""
+    with connection(conn) as conn:
+        row = conn.execute(
+            'SELECT entry_count, updated_at FROM coffee WHERE name = ?', (coffee_name,)
+        ).fetchone()
+    return tuple(row) if row else None
+
+
+def get_entries_version(conn: Optional[sqlite3.Connection] = None) -> Tuple[int, Optional[str]]:
+    """Version of all entries (and the coffee list)."""
+    with connection(conn) as conn:
+        row = conn.execute(
+            'SELECT COALESCE(SUM(entry_count), 0), MAX(updated_at) FROM coffee  -- advisor: allow-scan'
+        ).fetchone()
+    return tuple(row)
+
+
+def rename_coffee(old_name: str, new_name: str, conn: Optional[sqlite3.Connection] = None):
+    """Rename a coffee. Entries reference it by id, so only the catalog row changes."""
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                UPDATE coffee SET name = ?, updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+                WHERE name = ?
+            ''', (new_name, old_name))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            raise ValueError("Coffee already exists")
+    _notify_change({old_name, new_name}, catalog_changed=True)
+
+
+def _fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query: every word must match, the last as a prefix."""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return ''
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search_entries(query: str, cursor: Optional[Tuple[float, int]] = None,
+                   limit: int = 20, conn: Optional[sqlite3.Connection] = None) -> List[Dict]:
+    """Full-text search over coffee names, grinder settings and taste comments.
+    Results are ordered by bm25 relevance; each carries its rank and a snippet
+    with matches wrapped in SNIPPET_START/SNIPPET_END. Pass the (rank, id) of
+    the last result as cursor to fetch the next page.
+    """
+    match = _fts_query(query)
+    if not match:
+        return []
+    rank, entry_id = cursor or (float('-inf'), 0)
     
-    cursor.execute('SELECT DISTINCT coffee FROM espresso_entry ORDER BY coffee')
-    coffees = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return coffees
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        # bm25 is computed per query, so ranking the matches always needs a sort
+        cursor.execute('''
+            SELECT e.*, c.name as coffee, u.email as user_email, f.rank as rank,
+                   snippet(entry_fts, -1, ?, ?, '…', 12) as snippet
+            FROM entry_fts f
+            JOIN espresso_entry e ON e.id = f.rowid
+            JOIN coffee c ON c.id = e.coffee_id
+            LEFT JOIN user u ON e.user_id = u.id
+            WHERE entry_fts MATCH ? AND (f.rank, f.rowid) > (?, ?)
+            ORDER BY f.rank, f.rowid  -- advisor: allow-scan
+            LIMIT ?
+        ''', (SNIPPET_START, SNIPPET_END, match, rank, entry_id, limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+# Coffee statistics rollup
+
+# coffee_stats column prefix -> espresso_entry column it summarizes
+STAT_COLUMNS = {
+    'ratio': 'extraction_ratio',
+    'input': 'input_weight',
+    'output': 'output_weight',
+}
+
+
+def _summarize(values: List[float]) -> Tuple:
+    """Running aggregate (count, mean, m2, min, max) of a batch of values (Welford)."""
+    count, mean, m2 = 0, 0.0, 0.0
+    for value in values:
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        m2 += delta * (value - mean)
+    return count, mean, m2, min(values, default=None), max(values, default=None)
+
+
+def _combine(a: Tuple, b: Tuple) -> Tuple:
+    """Merge two running aggregates (Chan et al. parallel form of Welford)."""
+    n_a, mean_a, m2_a, min_a, max_a = a
+    n_b, mean_b, m2_b, min_b, max_b = b
+    if not n_a:
+        return b
+    if not n_b:
+        return a
+    count = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / count
+    m2 = m2_a + m2_b + delta * delta * n_a * n_b / count
+    return count, mean, m2, min(min_a, min_b), max(max_a, max_b)
+
+
+def _remove_value(a: Tuple, value: float) -> Tuple:
+    """Take one value back out of a running aggregate (inverse Welford step).
+    min/max are left as they were; the caller recomputes them if needed.
+    """
+    count, mean, m2, low, high = a
+    if count <= 1:
+        return 0, 0.0, 0.0, None, None
+    count -= 1
+    old_mean = mean
+    mean = old_mean - (value - old_mean) / count
+    m2 = max(m2 - (value - mean) * (value - old_mean), 0.0)
+    return count, mean, m2, low, high
+
+
+def _get_stats_row(cursor: sqlite3.Cursor, entry_id: int) -> Optional[Dict]:
+    """Get the columns of an entry that the statistics rollup needs."""
+    cursor.execute('''
+        SELECT user_id, coffee_id, grinder_setting, input_weight, output_weight,
+               extraction_ratio
+        FROM espresso_entry
+        WHERE id = ?
+    ''', (entry_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+
+def update_coffee_stats(coffee_id: int, added: List[Dict] = (), removed: List[Dict] = (),
+                        conn: Optional[sqlite3.Connection] = None):
+    """Fold added and removed entries into a coffee's coffee_stats row.
+    Call after the entry rows themselves have been written, in the same
+    transaction. Only removing a current min or max needs to look at the
+    coffee's entries again; everything else is O(1) per entry.
+    """
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM coffee_stats WHERE coffee_id = ?', (coffee_id,))
+        row = cursor.fetchone()
+        
+        values = {}
+        for prefix, column in STAT_COLUMNS.items():
+            if row:
+                aggregate = (row['entry_count'], row[f'{prefix}_mean'], row[f'{prefix}_m2'],
+                             row[f'{prefix}_min'], row[f'{prefix}_max'])
+            else:
+                aggregate = (0, 0.0, 0.0, None, None)
+            
+            stale_extreme = False
+            for entry in removed:
+                value = entry[column]
+                if aggregate[0] and (value <= aggregate[3] or value >= aggregate[4]):
+                    stale_extreme = True
+                aggregate = _remove_value(aggregate, value)
+            if stale_extreme and aggregate[0]:
+                cursor.execute(f'''
+                    SELECT (SELECT MIN({column}) FROM espresso_entry WHERE coffee_id = ?),
+                           (SELECT MAX({column}) FROM espresso_entry WHERE coffee_id = ?)
+                ''', (coffee_id, coffee_id))
+                low, high = cursor.fetchone()
+                aggregate = aggregate[:3] + (low, high)
+            
+            values[prefix] = _combine(aggregate, _summarize([entry[column] for entry in added]))
+        
+        cursor.execute('''
+            INSERT OR REPLACE INTO coffee_stats (
+                coffee_id, entry_count,
+                ratio_mean, ratio_m2, ratio_min, ratio_max,
+                input_mean, input_m2, input_min, input_max,
+                output_mean, output_m2, output_min, output_max
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (coffee_id, values['ratio'][0],
+              *values['ratio'][1:], *values['input'][1:], *values['output'][1:]))
+        
+        # Grinder setting frequencies, for the most common setting
+        for entry in added:
+            cursor.execute('''
+                INSERT INTO coffee_grinder_count (coffee_id, grinder_setting, entry_count)
+                VALUES (?, ?, 1)
+                ON CONFLICT (coffee_id, grinder_setting)
+                DO UPDATE SET entry_count = entry_count + 1
+            ''', (coffee_id, entry['grinder_setting']))
+        for entry in removed:
+            cursor.execute('''
+                UPDATE coffee_grinder_count SET entry_count = entry_count - 1
+                WHERE coffee_id = ? AND grinder_setting = ?
+            ''', (coffee_id, entry['grinder_setting']))
+        if removed:
+            cursor.execute('''
+                DELETE FROM coffee_grinder_count WHERE coffee_id = ? AND entry_count <= 0
+            ''', (coffee_id,))
+
+
+def rebuild_coffee_stats(conn: Optional[sqlite3.Connection] = None,
+                         coffee_ids: Optional[Tuple[int, int]] = None):
+    """Recompute every coffee's statistics from scratch, or only those of the
+    coffees with ids in the coffee_ids range (first, last inclusive).
+    Runs inside the caller's transaction when a connection is passed.
+    """
+    commit = conn is None
+    first, last = coffee_ids or (0, 2 ** 63 - 1)
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM coffee_stats WHERE coffee_id BETWEEN ? AND ?', (first, last))
+        # Sums of squared deviations from each coffee's mean, which stay as
+        # accurate as the incremental Welford/Chan updates (sum of squares minus
+        # squared sum cancels catastrophically). The means come from window
+        # functions over the same scan, ordered by coffee_id, so the cost doesn't
+        # depend on an index on coffee_id being there.
+        cursor.execute('''
+            WITH entry AS (
+                SELECT coffee_id, extraction_ratio, input_weight, output_weight,
+                       AVG(extraction_ratio) OVER coffee AS ratio_mean,
+                       AVG(input_weight) OVER coffee AS input_mean,
+                       AVG(output_weight) OVER coffee AS output_mean
+                FROM espresso_entry
+                WHERE coffee_id BETWEEN ? AND ?  -- advisor: allow-scan
+                WINDOW coffee AS (PARTITION BY coffee_id)
+            )
+            INSERT INTO coffee_stats (
+                coffee_id, entry_count,
+                ratio_mean, ratio_m2, ratio_min, ratio_max,
+                input_mean, input_m2, input_min, input_max,
+                output_mean, output_m2, output_min, output_max
+            )
+            SELECT coffee_id, COUNT(*),
+                   ratio_mean,
+                   SUM((extraction_ratio - ratio_mean) * (extraction_ratio - ratio_mean)),
+                   MIN(extraction_ratio), MAX(extraction_ratio),
+                   input_mean,
+                   SUM((input_weight - input_mean) * (input_weight - input_mean)),
+                   MIN(input_weight), MAX(input_weight),
+                   output_mean,
+                   SUM((output_weight - output_mean) * (output_weight - output_mean)),
+                   MIN(output_weight), MAX(output_weight)
+            FROM entry
+            GROUP BY coffee_id
+        ''', (first, last))
+        cursor.execute('DELETE FROM coffee_grinder_count WHERE coffee_id BETWEEN ? AND ?',
+                       (first, last))
+        cursor.execute('''
+            INSERT INTO coffee_grinder_count (coffee_id, grinder_setting, entry_count)
+            SELECT coffee_id, grinder_setting, COUNT(*)
+            FROM espresso_entry
+            WHERE coffee_id BETWEEN ? AND ?
+            GROUP BY coffee_id, grinder_setting  -- advisor: allow-scan
+        ''', (first, last))
+        if commit:
+            conn.commit()
+
+
+def get_coffee_stats(coffee_name: str, conn: Optional[sqlite3.Connection] = None) -> Optional[Dict]:
+    """Get count, mean, stddev, min and max of ratio, input and output weight
+    for a coffee, plus its most common grinder setting.
+    """
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT s.*, (
+                SELECT g.grinder_setting FROM coffee_grinder_count g
+                WHERE g.coffee_id = s.coffee_id
+                ORDER BY g.entry_count DESC
+                LIMIT 1
+            ) AS common_grinder
+            FROM coffee c
+            JOIN coffee_stats s ON s.coffee_id = c.id
+            WHERE c.name = ?
+        ''', (coffee_name,))
+        row = cursor.fetchone()
+    
+    if not row or not row['entry_count']:
+        return None
+    
+    count = row['entry_count']
+    stats = {'count': count, 'common_grinder': row['common_grinder']}
+    for prefix in STAT_COLUMNS:
+        m2 = row[f'{prefix}_m2']
+        stats[prefix] = {
+            'mean': row[f'{prefix}_mean'],
+            'stddev': math.sqrt(m2 / (count - 1)) if count > 1 else 0.0,
+            'min': row[f'{prefix}_min'],
+            'max': row[f'{prefix}_max'],
+        }
+    return stats
 
 
 def calculate_extraction_ratio(input_weight: float, output_weight: float) -> float:
@@ -248,111 +905,231 @@ def calculate_extraction_ratio(input_weight: float, output_weight: float) -> flo
 
 # User management functions
 
-def create_user(email: str, password: str) -> int:
+def create_user(email: str, password: str, conn: Optional[sqlite3.Connection] = None) -> int:
     """Create a new user with hashed password."""
-    conn = get_db()
-    cursor = conn.cursor()
+    password_hash = passwords.hash_password(password)
     
-    password_hash = generate_password_hash(password)
-    
-    try:
-        cursor.execute('''
-            INSERT INTO user (email, password_hash)
-            VALUES (?, ?)
-        ''', (email, password_hash))
-        
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return user_id
-    except sqlite3.IntegrityError:
-        conn.close()
-        raise ValueError("Email already exists")
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT INTO user (email, password_hash)
+                VALUES (?, ?)
+            ''', (email, password_hash))
+            
+            user_id = cursor.lastrowid
+            conn.commit()
+            return user_id
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            raise ValueError("Email already exists")
 
 
-def get_user_by_email(email: str) -> Optional[Dict]:
+def get_user_by_email(email: str, conn: Optional[sqlite3.Connection] = None) -> Optional[Dict]:
     """Get user by email."""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM user WHERE email = ?', (email,))
-    row = cursor.fetchone()
-    conn.close()
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM user WHERE email = ?', (email,))
+        row = cursor.fetchone()
     
     return dict(row) if row else None
 
 
-def get_user_by_id(user_id: int) -> Optional[Dict]:
+def get_user_by_id(user_id: int, conn: Optional[sqlite3.Connection] = None) -> Optional[Dict]:
     """Get user by ID."""
-    conn = get_db()
-    cursor = conn.cursor()
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM user WHERE id = ?', (user_id,))
+        row = cursor.fetchone()
     
-    cursor.execute('SELECT * FROM user WHERE id = ?', (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    return dict(row) if row else None
+
+
+def get_user_profile(user_id: int, conn: Optional[sqlite3.Connection] = None) -> Optional[Dict]:
+    """Get a user's public fields by ID (no password hash), e.g. for the session user."""
+    with connection(conn) as conn:
+        row = conn.execute('SELECT id, email, created_at FROM user WHERE id = ?',
+                           (user_id,)).fetchone()
     
     return dict(row) if row else None
 
 
+# User listeners: called with the user id after a committed change to the user row
+_user_listeners = []
+
+
+def add_user_listener(listener):
+    """Register listener(user_id) to be called after a user's account changes."""
+    _user_listeners.append(listener)
+
+
+def take_bucket_token(key: str, capacity: float, refill_rate: float, now: float,
+                      conn: Optional[sqlite3.Connection] = None) -> Tuple[bool, float]:
+    """Take one token from the login_bucket row for key, refilling it first.
+    Buckets start full and refill at refill_rate tokens per second.
+    Returns (allowed, tokens left). conn must not have a transaction open.
+    """
+    with connection(conn) as conn:
+        begin_immediate(conn)
+        try:
+            row = conn.execute('SELECT tokens, updated_at FROM login_bucket WHERE key = ?',
+                               (key,)).fetchone()
+            tokens = capacity if row is None else min(
+                capacity, row['tokens'] + max(now - row['updated_at'], 0) * refill_rate
+            )
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute('''
+                INSERT OR REPLACE INTO login_bucket (key, tokens, updated_at) VALUES (?, ?, ?)
+            ''', (key, tokens, now))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return allowed, tokens
+
+
+def prune_buckets(before: float, conn: Optional[sqlite3.Connection] = None):
+    """Delete login_bucket rows untouched since before (they have refilled anyway)."""
+    with connection(conn) as conn:
+        conn.execute('DELETE FROM login_bucket WHERE updated_at < ?  -- advisor: allow-scan', (before,))
+        conn.commit()
+
+
 def verify_password(user: Dict, password: str) -> bool:
     """Verify password against user's hash."""
-    return check_password_hash(user['password_hash'], password)
+    return passwords.check_password(user['password_hash'], password)
 
 
-def update_user_password(user_id: int, new_password: str):
+def update_user_password(user_id: int, new_password: str,
+                         conn: Optional[sqlite3.Connection] = None):
     """Update user's password."""
-    conn = get_db()
-    cursor = conn.cursor()
+    password_hash = passwords.hash_password(new_password)
     
-    password_hash = generate_password_hash(new_password)
-    
-    cursor.execute('''
-        UPDATE user
-        SET password_hash = ?
-        WHERE id = ?
-    ''', (password_hash, user_id))
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE user
+            SET password_hash = ?
+            WHERE id = ?
+        ''', (password_hash, user_id))
+        
+        conn.commit()
     
-    conn.commit()
-    conn.close()
+    for listener in _user_listeners:
+        listener(user_id)
 
 
 def update_entry(entry_id: int, user_id: int, coffee: str, grinder_setting: str,
-                 input_weight: float, output_weight: float, taste_comment: str = ''):
+                 input_weight: float, output_weight: float, taste_comment: str = '',
+                 conn: Optional[sqlite3.Connection] = None):
     """Update an espresso entry. Only the owner can update."""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Verify ownership
-    cursor.execute('SELECT user_id FROM espresso_entry WHERE id = ?', (entry_id,))
-    row = cursor.fetchone()
-    if not row or row[0] != user_id:
-        conn.close()
-        raise PermissionError("You can only edit your own entries")
-    
-    cursor.execute('''
-        UPDATE espresso_entry
-        SET coffee = ?, grinder_setting = ?, input_weight = ?, 
-            output_weight = ?, taste_comment = ?
-        WHERE id = ? AND user_id = ?
-    ''', (coffee, grinder_setting, input_weight, output_weight, taste_comment, entry_id, user_id))
-    
-    conn.commit()
-    conn.close()
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        # Verify ownership
+        old = _get_stats_row(cursor, entry_id)
+        if not old or old['user_id'] != user_id:
+            raise PermissionError("You can only edit your own entries")
+        
+        coffee_id = get_or_create_coffee_id(coffee, conn=conn)
+        cursor.execute('''
+            UPDATE espresso_entry
+            SET coffee_id = ?, grinder_setting = ?, input_weight = ?, 
+                output_weight = ?, taste_comment = ?
+            WHERE id = ? AND user_id = ?
+        ''', (coffee_id, grinder_setting, input_weight, output_weight, taste_comment, entry_id, user_id))
+        
+        new = _get_stats_row(cursor, entry_id)
+        if old['coffee_id'] == coffee_id:
+            update_coffee_stats(coffee_id, added=[new], removed=[old], conn=conn)
+        else:
+            update_coffee_stats(old['coffee_id'], removed=[old], conn=conn)
+            update_coffee_stats(coffee_id, added=[new], conn=conn)
+        
+        conn.commit()
+        notify_entries_changed([old['coffee_id'], coffee_id], conn=conn)
 
 
-def delete_entry(entry_id: int, user_id: int):
+def delete_entry(entry_id: int, user_id: int, conn: Optional[sqlite3.Connection] = None):
     """Delete an espresso entry. Only the owner can delete."""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Verify ownership
-    cursor.execute('SELECT user_id FROM espresso_entry WHERE id = ?', (entry_id,))
-    row = cursor.fetchone()
-    if not row or row[0] != user_id:
-        conn.close()
-        raise PermissionError("You can only delete your own entries")
-    
-    cursor.execute('DELETE FROM espresso_entry WHERE id = ? AND user_id = ?', (entry_id, user_id))
-    
-    conn.commit()
-    conn.close()
+    with connection(conn) as conn:
+        cursor = conn.cursor()
+        
+        # Verify ownership
+        old = _get_stats_row(cursor, entry_id)
+        if not old or old['user_id'] != user_id:
+            raise PermissionError("You can only delete your own entries")
+        
+        cursor.execute('DELETE FROM espresso_entry WHERE id = ? AND user_id = ?', (entry_id, user_id))
+        update_coffee_stats(old['coffee_id'], removed=[old], conn=conn)
+        
+        conn.commit()
+        notify_entries_changed([old['coffee_id']], conn=conn)
+
+
+# Email outbox
+
+def enqueue_email(recipient: str, subject: str, body: str, now: float,
+                  conn: Optional[sqlite3.Connection] = None) -> int:
+    """Queue an email to be sent by the outbox sender. Returns its id."""
+    with connection(conn) as conn:
+        cursor = conn.execute('''
+            INSERT INTO email_outbox (recipient, subject, body, next_attempt_at)
+            VALUES (?, ?, ?, ?)
+        ''', (recipient, subject, body, now))
+        conn.commit()
+        return cursor.lastrowid
+
+
+def claim_due_emails(now: float, lease: float, limit: int,
+                     conn: Optional[sqlite3.Connection] = None) -> List[Dict]:
+    """Claim up to limit due emails for sending, oldest due first.
+    Claimed emails aren't due again until now + lease, so concurrent senders
+    don't pick them up, and a sender that dies is retried after the lease.
+    conn must not have a transaction open.
+    """
+    with connection(conn) as conn:
+        begin_immediate(conn)
+        try:
+            rows = conn.execute('''
+                SELECT id, recipient, subject, body, attempts
+                FROM email_outbox
+                WHERE sent_at IS NULL AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ?
+            ''', (now, limit)).fetchall()
+            conn.executemany('UPDATE email_outbox SET next_attempt_at = ? WHERE id = ?',
+                             [(now + lease, row['id']) for row in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return [dict(row) for row in rows]
+
+
+def mark_email_sent(email_id: int, conn: Optional[sqlite3.Connection] = None):
+    """Record that an email was delivered to the SMTP server."""
+    with connection(conn) as conn:
+        conn.execute('''
+            UPDATE email_outbox
+            SET sent_at = CURRENT_TIMESTAMP, attempts = attempts + 1, last_error = NULL
+            WHERE id = ?
+        ''', (email_id,))
+        conn.commit()
+
+
+def mark_email_failed(email_id: int, error: str, retry_at: Optional[float],
+                      conn: Optional[sqlite3.Connection] = None):
+    """Record a failed attempt; retry_at None gives up on the email."""
+    with connection(conn) as conn:
+        conn.execute('''
+            UPDATE email_outbox
+            SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?
+            WHERE id = ?
+        ''', (error, retry_at, email_id))
+        conn.commit()
@@ -0,0 +1,93 @@
+"""Minimal SMTP server that accepts every message and keeps it in memory.
+
+For local development and tests, point the app at it instead of a real server:
+
+    python debug_smtp.py --port 1025
+    MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_USE_TLS=false flask run
+
+Received messages are printed, and kept in ``DebugSMTPServer.messages`` when
+the server is started from Python (``server = DebugSMTPServer(); server.start()``).
+"""
+import argparse
+import socketserver
+import threading
+from email import message_from_bytes
+from typing import List, Tuple
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 debug-smtp ready')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 debug-smtp')
+            elif verb == 'MAIL':
+                sender, recipients = command.split(':', 1)[1].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for data_line in self.rfile:
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                self.server.received(sender, recipients, b''.join(data))
+                self.reply('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                sender, recipients = (None, []) if verb == 'RSET' else (sender, recipients)
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class DebugSMTPServer(socketserver.ThreadingTCPServer):
+    """SMTP sink; each message is stored as (sender, recipients, email.message.Message)."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host: str = 'localhost', port: int = 1025, verbose: bool = False):
+        super().__init__((host, port), _SMTPHandler)
+        self.verbose = verbose
+        self.messages: List[Tuple] = []
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    def received(self, sender, recipients, data: bytes):
+        message = message_from_bytes(data)
+        self.messages.append((sender, recipients, message))
+        if self.verbose:
+            print(f'---------- from {sender} to {", ".join(recipients)}')
+            print(data.decode(errors='replace'))
+
+    def start(self) -> 'DebugSMTPServer':
+        """Serve in a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1025)
+    args = parser.parse_args()
+    print(f'Debug SMTP server listening on {args.host}:{args.port}')
+    DebugSMTPServer(args.host, args.port, verbose=True).serve_forever()
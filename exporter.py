@@ -0,0 +1,35 @@
+import csv
+import io
+import json
+from typing import Iterable, Iterator
+
+import sqlite3
+
+
+# Same column names the importer reads, so an export can be imported again
+FIELDS = ('id', 'created_at', 'coffee', 'grinder_setting', 'input_weight',
+          'output_weight', 'extraction_ratio', 'taste_comment')
+
+
+def iter_csv(rows: Iterable[sqlite3.Row]) -> Iterator[str]:
+    """Render rows as CSV text, one line per chunk, header first."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writerow(FIELDS)
+    yield flush()
+    for row in rows:
+        writer.writerow([row[field] for field in FIELDS])
+        yield flush()
+
+
+def iter_ndjson(rows: Iterable[sqlite3.Row]) -> Iterator[str]:
+    """Render rows as newline-delimited JSON objects."""
+    for row in rows:
+        yield json.dumps({field: row[field] for field in FIELDS}, ensure_ascii=False) + '\n'
@@ -0,0 +1,163 @@
+import csv
+import io
+import json
+import sqlite3
+from datetime import datetime
+from itertools import islice
+from typing import Dict, IO, Iterator, List, Optional, Tuple
+
+import database
+from validation import validate_entry
+
+
+CHUNK_SIZE = 1000
+
+# Only the first errors are kept for the report; the rest are just counted
+MAX_REPORTED_ERRORS = 100
+
+FORMATS = ('csv', 'jsonl')
+FIELDS = ('coffee', 'grinder_setting', 'input_weight', 'output_weight', 'taste_comment', 'created_at')
+
+
+def detect_format(filename: str) -> str:
+    """Guess the import format from a file name."""
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def iter_rows(stream: IO[str], fmt: str) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """Lazily parse a CSV (with header row) or JSON Lines stream.
+    Yields (line_number, row, error); row is None when the line couldn't be parsed.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row, None
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, f'Invalid JSON: {e}'
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, 'Expected a JSON object'
+                continue
+            yield line_number, row, None
+    else:
+        raise ValueError(f'Unsupported import format: {fmt}')
+
+
+def clean_row(row: Dict) -> Tuple[Optional[Dict], List[str]]:
+    """Validate one imported row with the same rules as the add entry form.
+    Returns (entry, errors); entry is None if the row is invalid.
+    """
+    values = {field: '' if row.get(field) is None else str(row[field]).strip()
+              for field in FIELDS}
+    errors = validate_entry(values['coffee'], values['grinder_setting'],
+                            values['input_weight'], values['output_weight'])
+
+    created_at = None
+    if values['created_at']:
+        try:
+            created_at = datetime.fromisoformat(values['created_at']).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            errors.append('Created at must be an ISO date or timestamp')
+
+    if errors:
+        return None, errors
+    return {
+        'coffee': values['coffee'],
+        'grinder_setting': values['grinder_setting'],
+        'input_weight': float(values['input_weight']),
+        'output_weight': float(values['output_weight']),
+        'taste_comment': values['taste_comment'],
+        'created_at': created_at,
+    }, []
+
+
+def insert_chunk(user_id: int, entries: List[Dict], conn: sqlite3.Connection) -> int:
+    """Insert a batch of validated entries in one transaction with executemany.
+    conn must not have a transaction open (RuntimeError otherwise).
+    """
+    cursor = conn.cursor()
+    database.begin_immediate(conn)
+    try:
+        coffee_ids = {name: database.get_or_create_coffee_id(name, conn=conn)
+                      for name in {entry['coffee'] for entry in entries}}
+
+        # Ids are AUTOINCREMENT and the write lock is held, so the new rows are exactly
+        # those above the current maximum
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM espresso_entry')
+        last_id = cursor.fetchone()[0]
+
+        cursor.executemany('''
+            INSERT INTO espresso_entry (user_id, coffee_id, grinder_setting, input_weight,
+                                       output_weight, taste_comment, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', [(user_id, coffee_ids[entry['coffee']], entry['grinder_setting'],
+               entry['input_weight'], entry['output_weight'], entry['taste_comment'],
+               entry['created_at']) for entry in entries])
+
+        # Fold the new rows into the per-coffee statistics, one merge per coffee
+        cursor.execute('''
+            SELECT user_id, coffee_id, grinder_setting, input_weight, output_weight,
+                   extraction_ratio
+            FROM espresso_entry
+            WHERE id > ?
+        ''', (last_id,))
+        added = {}
+        for row in cursor.fetchall():
+            added.setdefault(row['coffee_id'], []).append(dict(row))
+        for coffee_id, rows in added.items():
+            database.update_coffee_stats(coffee_id, added=rows, conn=conn)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    database.notify_entries_changed(coffee_ids.values(), conn=conn)
+    return len(entries)
+
+
+def import_entries(stream: IO[str], user_id: int, fmt: str = 'csv',
+                   chunk_size: int = CHUNK_SIZE,
+                   conn: Optional[sqlite3.Connection] = None) -> Dict:
+    """Stream entries from a CSV or JSON Lines file into the database.
+    Valid rows are inserted in chunks of chunk_size, each in its own
+    transaction; invalid rows are reported and skipped.
+    Returns {'imported': int, 'error_count': int, 'errors': [(line, message)]}.
+    """
+    result = {'imported': 0, 'error_count': 0, 'errors': []}
+
+    def report(line_number, message):
+        result['error_count'] += 1
+        if len(result['errors']) < MAX_REPORTED_ERRORS:
+            result['errors'].append((line_number, message))
+
+    def valid_entries():
+        for line_number, row, error in iter_rows(stream, fmt):
+            if error:
+                report(line_number, error)
+                continue
+            entry, errors = clean_row(row)
+            if errors:
+                report(line_number, '; '.join(errors))
+                continue
+            yield entry
+
+    with database.connection(conn) as conn:
+        entries = valid_entries()
+        while True:
+            chunk = list(islice(entries, chunk_size))
+            if not chunk:
+                break
+            result['imported'] += insert_chunk(user_id, chunk, conn)
+
+    return result
+
+
+def open_text(binary: IO[bytes]) -> IO[str]:
+    """Wrap an uploaded binary file for text parsing (tolerates a UTF-8 BOM)."""
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
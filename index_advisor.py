@@ -0,0 +1,131 @@
+"""Index advisor: run EXPLAIN QUERY PLAN over every SQL statement in database.py.
+
+Statements are found by parsing the module source, so any new query is checked
+without being registered anywhere. A plan step that scans a whole table or index,
+or sorts through a temporary B-tree, is reported as a problem. Intentional scans
+can be allowed by putting the marker comment ``-- advisor: allow-scan`` in the SQL.
+SQL templates filled in with ``str.format()`` are checked with each placeholder
+replaced by ``*`` (they are only used for SELECT column lists).
+"""
+import ast
+import inspect
+import re
+import sqlite3
+import string
+from typing import List, Dict, Optional
+
+import database
+
+
+ALLOW_MARKER = 'advisor: allow-scan'
+
+EXECUTE_METHODS = {'execute', 'executemany'}
+PLANNED_KEYWORDS = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+# Full table or full index scans (virtual tables such as FTS are excluded)
+_SCAN = re.compile(r'^SCAN \w+( USING (COVERING )?INDEX \w+)?$')
+_TEMP_SORT = re.compile(r'^USE TEMP B-TREE')
+
+
+def _fill_template(template: str) -> str:
+    """Replace every str.format() placeholder in a SQL template with '*'."""
+    return ''.join(literal + ('*' if field is not None else '')
+                   for literal, field, _, _ in string.Formatter().parse(template))
+
+
+def extract_statements(source: str) -> List[Dict]:
+    """Find SQL passed to execute()/executemany() in Python source.
+    Returns dicts with function, line and sql; sql is None for statements
+    built at runtime, which can't be checked statically.
+    """
+    statements = {}
+    tree = ast.parse(source)
+    for func in ast.walk(tree):
+        if not isinstance(func, ast.FunctionDef):
+            continue
+
+        # Resolve `sql = '...'` assignments used as the statement argument
+        constants = {}
+        for node in ast.walk(func):
+            if (isinstance(node, ast.Assign) and len(node.targets) == 1
+                    and isinstance(node.targets[0], ast.Name)
+                    and isinstance(node.value, ast.Constant)
+                    and isinstance(node.value.value, str)):
+                constants[node.targets[0].id] = node.value.value
+
+        for node in ast.walk(func):
+            if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                    and node.func.attr in EXECUTE_METHODS and node.args):
+                continue
+            arg = node.args[0]
+            sql = None
+            if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+                sql = arg.value
+            elif isinstance(arg, ast.Name):
+                sql = constants.get(arg.id)
+            elif (isinstance(arg, ast.Call) and isinstance(arg.func, ast.Attribute)
+                    and arg.func.attr == 'format' and isinstance(arg.func.value, ast.Constant)
+                    and isinstance(arg.func.value.value, str)):
+                sql = _fill_template(arg.func.value.value)
+            statements.setdefault(node.lineno, {
+                'function': func.name,
+                'line': node.lineno,
+                'sql': sql,
+            })
+
+    return [statements[line] for line in sorted(statements)]
+
+
+def explain(conn: sqlite3.Connection, sql: str) -> List[str]:
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement."""
+    params = (None,) * sql.count('?')
+    rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+    return [row[3] for row in rows]
+
+
+def find_problems(plan: List[str]) -> List[str]:
+    """Return the plan steps that are full scans or temporary sorts."""
+    return [step for step in plan if _SCAN.match(step) or _TEMP_SORT.match(step)]
+
+
+def analyze(conn: Optional[sqlite3.Connection] = None, source: Optional[str] = None) -> List[Dict]:
+    """Explain every statement in database.py (or the given source).
+    Each result carries the statement's plan, its problems, and whether
+    it was allowed or skipped.
+    """
+    if source is None:
+        source = inspect.getsource(database)
+
+    results = []
+    with database.connection(conn) as conn:
+        for statement in extract_statements(source):
+            sql = statement['sql']
+            result = dict(statement, plan=[], problems=[], allowed=False, skipped=False)
+            keyword = sql.lstrip().split(None, 1)[0].upper() if sql and sql.strip() else ''
+            if keyword not in PLANNED_KEYWORDS:
+                result['skipped'] = True
+            else:
+                result['plan'] = explain(conn, sql)
+                result['problems'] = find_problems(result['plan'])
+                result['allowed'] = ALLOW_MARKER in sql
+            results.append(result)
+    return results
+
+
+def format_report(results: List[Dict]) -> List[str]:
+    """Render analysis results as report lines."""
+    lines = []
+    for result in results:
+        location = f"database.py:{result['line']} {result['function']}()"
+        if result['skipped']:
+            if result['sql'] is None:
+                lines.append(f'SKIP {location}: statement is built at runtime')
+            continue
+        if result['problems'] and not result['allowed']:
+            lines.append(f'FAIL {location}')
+            lines.extend(f'    {step}' for step in result['problems'])
+        elif result['problems']:
+            lines.append(f'ALLOW {location}')
+        else:
+            lines.append(f'OK   {location}')
+    return lines
@@ -0,0 +1,932 @@
+"""Versioned schema migrations.
+
+Each migration is a function taking a connection, listed in MIGRATIONS under
+an increasing version number. upgrade() applies the ones not yet recorded in
+the schema_version table, each in one transaction with its version row, and is
+run once per deploy with `flask db-upgrade`. Worker processes only call check(),
+which warns about unrecorded migrations and never changes the schema.
+
+Migrations 1-10 replace the old init_db() and are idempotent, so databases
+created before schema_version existed are brought up to date by running them all.
+New migrations don't need to be: they only ever run once per database.
+
+Changes SQLite can't make with ALTER TABLE need the table rebuilt. On large
+tables use copy_table() from the migration's COPY_PHASES entry, which copies
+rows in short chunked transactions while the app keeps writing, and
+swap_table() in the migration itself, so only the swap holds the write lock.
+Filling a new table from existing rows works the same way with backfill(),
+after create_entry_indexes() so the backfill's lookups by coffee are index
+searches.
+"""
+import bisect
+import logging
+import os
+import re
+import sqlite3
+from typing import Callable, Dict, List, Optional, Tuple
+
+from werkzeug.security import generate_password_hash
+
+import database
+
+
+logger = logging.getLogger(__name__)
+
+# Rows copied per transaction by copy_table
+REBUILD_CHUNK_SIZE = int(os.environ.get('MIGRATION_CHUNK_SIZE', 5000))
+
+
+# Current espresso_entry definition. extraction_ratio is computed by SQLite
+# on write, so it can be sorted, filtered and indexed without Python work.
+# updated_at (millisecond precision) is bumped by trg_entry_touch on edits.
+ENTRY_TABLE_SQL = '''
+    CREATE TABLE {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        coffee_id INTEGER NOT NULL,
+        grinder_setting TEXT NOT NULL,
+        input_weight REAL NOT NULL,
+        output_weight REAL NOT NULL,
+        extraction_ratio REAL GENERATED ALWAYS AS (
+            CASE WHEN input_weight = 0 THEN 0.0
+                 ELSE ROUND(output_weight / input_weight, 2) END
+        ) STORED,
+        taste_comment TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+        FOREIGN KEY (user_id) REFERENCES user(id),
+        FOREIGN KEY (coffee_id) REFERENCES coffee(id)
+    )
+'''
+
+# espresso_entry as it was before coffee names moved to the coffee table
+LEGACY_ENTRY_TABLE_SQL = '''
+    CREATE TABLE {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        coffee TEXT NOT NULL,
+        grinder_setting TEXT NOT NULL,
+        input_weight REAL NOT NULL,
+        output_weight REAL NOT NULL,
+        taste_comment TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES user(id)
+    )
+'''
+
+# Composite entry indexes, matching the listing queries (filter column, then
+# created_at) so results come back already sorted
+ENTRY_INDEXES = {
+    'idx_espresso_entry_user_created': 'user_id, created_at',
+    'idx_espresso_entry_coffee_created': 'coffee_id, created_at',
+    'idx_espresso_entry_created': 'created_at, id',
+    'idx_espresso_entry_coffee_ratio': 'coffee_id, extraction_ratio',
+}
+
+
+def create_tables(conn: sqlite3.Connection):
+    """Create the user, coffee and espresso_entry tables."""
+    cursor = conn.cursor()
+    
+    # Create user table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Coffee catalog: one row per coffee name with its entry count, kept
+    # current by triggers so listing coffees doesn't walk every entry.
+    # Entries reference it by id instead of repeating the name.
+    # updated_at is the last time any of the coffee's entries was added,
+    # changed or deleted (see add_coffee_triggers).
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS coffee (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            entry_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            change_seq INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # Create espresso_entry table (check if user_id column exists)
+    cursor.execute(ENTRY_TABLE_SQL.format(table='IF NOT EXISTS espresso_entry'))
+
+
+def copy_entry_user_id(conn: sqlite3.Connection):
+    """Copy espresso_entry into the definition with a NOT NULL user_id (for migration 2)."""
+    # SQLite doesn't support ALTER COLUMN, so the table is rebuilt. Existing
+    # entries go to the anonymous user that add_entry_user_id creates.
+    if 'user_id' not in _columns(conn, 'espresso_entry'):
+        copy_table(conn, 'espresso_entry', LEGACY_ENTRY_TABLE_SQL, {
+            'id': 'e.id',
+            'user_id': '1',
+            'coffee': 'e.coffee',
+            'grinder_setting': 'e.grinder_setting',
+            'input_weight': 'e.input_weight',
+            'output_weight': 'e.output_weight',
+            'taste_comment': 'e.taste_comment',
+            'created_at': 'e.created_at',
+        }, indexes={})
+
+
+def add_entry_user_id(conn: sqlite3.Connection):
+    """Add espresso_entry.user_id, assigning existing entries to an anonymous user."""
+    cursor = conn.cursor()
+    
+    if 'user_id' not in _columns(conn, 'espresso_entry'):
+        # Create a default anonymous user for existing entries
+        cursor.execute('''
+            INSERT OR IGNORE INTO user (id, email, password_hash)
+            VALUES (1, 'anonymous@system.local', ?)
+        ''', (generate_password_hash('migration'),))
+        
+        # Swap in the copy made by copy_entry_user_id. Migration 3 rebuilds
+        # the table again, so its indexes and triggers aren't kept.
+        swap_table(conn, 'espresso_entry', recreate=False)
+
+
+def _entry_table_outdated(columns: List[str]) -> bool:
+    """Whether espresso_entry (with these columns) still has the coffee name
+    column or lacks the extraction_ratio or updated_at columns."""
+    return 'coffee' in columns or 'extraction_ratio' not in columns or 'updated_at' not in columns
+
+
+def copy_entry_table(conn: sqlite3.Connection):
+    """Copy espresso_entry into the current definition (for migration 3)."""
+    columns = _columns(conn, 'espresso_entry')
+    if not _entry_table_outdated(columns):
+        return
+    
+    if 'coffee' in columns:
+        # Replace the coffee name with a coffee_id reference
+        conn.execute('''
+            INSERT OR IGNORE INTO coffee (name)
+            SELECT DISTINCT coffee FROM espresso_entry
+        ''')
+        conn.commit()
+        coffee_id, join = 'c.id', 'JOIN coffee c ON c.name = e.coffee'
+        # Entries written during the copy may name a new coffee
+        prelude = 'INSERT OR IGNORE INTO coffee (name) VALUES (NEW.coffee);'
+    else:
+        coffee_id, join, prelude = 'e.coffee_id', '', ''
+    
+    copy_table(conn, 'espresso_entry', ENTRY_TABLE_SQL, {
+        'id': 'e.id',
+        'user_id': 'e.user_id',
+        'coffee_id': coffee_id,
+        'grinder_setting': 'e.grinder_setting',
+        'input_weight': 'e.input_weight',
+        'output_weight': 'e.output_weight',
+        'taste_comment': 'e.taste_comment',
+        'created_at': 'e.created_at',
+        'updated_at': 'e.updated_at' if 'updated_at' in columns else 'e.created_at',
+    }, join=join, trigger_prelude=prelude, indexes=ENTRY_INDEXES)
+
+
+def rebuild_entry_table(conn: sqlite3.Connection):
+    """Move entries to coffee_id references with stored extraction_ratio and updated_at."""
+    cursor = conn.cursor()
+    
+    # Swap in the copy made by copy_entry_table, which comes with ENTRY_INDEXES
+    # already built. The later migrations recreate the triggers.
+    if _entry_table_outdated(_columns(conn, 'espresso_entry')):
+        swap_table(conn, 'espresso_entry', recreate=False)
+        # Count every coffee's entries in one pass over the coffee index
+        cursor.execute('''
+            UPDATE coffee SET entry_count = counts.entry_count
+            FROM (
+                SELECT coffee_id, COUNT(*) AS entry_count
+                FROM espresso_entry
+                GROUP BY coffee_id
+            ) AS counts
+            WHERE counts.coffee_id = coffee.id
+        ''')
+        cursor.execute('''
+            UPDATE coffee SET entry_count = 0
+            WHERE entry_count != 0 AND id NOT IN (SELECT coffee_id FROM espresso_entry)
+        ''')
+
+
+def add_coffee_triggers(conn: sqlite3.Connection):
+    """Maintain coffee entry counts and updated_at with triggers."""
+    cursor = conn.cursor()
+    
+    # Add coffee.updated_at, replacing the count triggers that predate it
+    cursor.execute('PRAGMA table_info(coffee)')
+    if 'updated_at' not in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE coffee ADD COLUMN updated_at TIMESTAMP')
+        cursor.execute('''
+            UPDATE coffee SET updated_at = COALESCE(
+                (SELECT MAX(updated_at) FROM espresso_entry WHERE coffee_id = coffee.id),
+                created_at
+            )
+        ''')
+        for trigger in ('insert', 'update', 'delete'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS trg_coffee_count_{trigger}')
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_coffee_count_insert
+        AFTER INSERT ON espresso_entry
+        BEGIN
+            UPDATE coffee SET entry_count = entry_count + 1,
+                              updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+            WHERE id = NEW.coffee_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_coffee_count_update
+        AFTER UPDATE OF coffee_id ON espresso_entry
+        WHEN OLD.coffee_id IS NOT NEW.coffee_id
+        BEGIN
+            UPDATE coffee SET entry_count = entry_count - 1,
+                              updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+            WHERE id = OLD.coffee_id;
+            UPDATE coffee SET entry_count = entry_count + 1,
+                              updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+            WHERE id = NEW.coffee_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_coffee_count_delete
+        AFTER DELETE ON espresso_entry
+        BEGIN
+            UPDATE coffee SET entry_count = entry_count - 1,
+                              updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+            WHERE id = OLD.coffee_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_entry_touch
+        AFTER UPDATE OF coffee_id, grinder_setting, input_weight, output_weight,
+                        taste_comment ON espresso_entry
+        BEGIN
+            UPDATE espresso_entry SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+            WHERE id = NEW.id;
+            UPDATE coffee SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+            WHERE id = NEW.coffee_id;
+        END
+    ''')
+
+
+def add_change_counter(conn: sqlite3.Connection):
+    """Add the cross-process change counter."""
+    cursor = conn.cursor()
+    
+    # Change counter shared by all worker processes (see poll_changes). seq is
+    # bumped on every change to a coffee row, which the triggers above make on
+    # every entry write, and stamped on the row as change_seq. catalog_seq is
+    # bumped when the coffee list changes (a rename, or a coffee gaining its
+    # first entry or losing its last).
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_counter (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            seq INTEGER NOT NULL DEFAULT 0,
+            catalog_seq INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO change_counter (id) VALUES (1)')
+    cursor.execute('PRAGMA table_info(coffee)')
+    if 'change_seq' not in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE coffee ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_coffee_change_seq ON coffee(change_seq)
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_coffee_changed
+        AFTER UPDATE OF name, entry_count, updated_at ON coffee
+        BEGIN
+            UPDATE change_counter
+            SET seq = seq + 1,
+                catalog_seq = catalog_seq + (OLD.name IS NOT NEW.name
+                                             OR (OLD.entry_count > 0) != (NEW.entry_count > 0))
+            WHERE id = 1;
+            UPDATE coffee SET change_seq = (SELECT seq FROM change_counter WHERE id = 1)
+            WHERE id = NEW.id;
+        END
+    ''')
+
+
+def add_coffee_stats(conn: sqlite3.Connection):
+    """Add the per-coffee statistics rollup."""
+    cursor = conn.cursor()
+    
+    # Per-coffee statistics rollup, maintained incrementally by the entry
+    # write functions (see update_coffee_stats). fill_coffee_stats has filled
+    # it already, unless the migration runs without its copy phase.
+    if _create_coffee_stats(cursor):
+        database.rebuild_coffee_stats(conn)
+
+
+def fill_coffee_stats(conn: sqlite3.Connection):
+    """Create the statistics rollup and fill it a range of coffees at a time
+    (for migration 6)."""
+    create_entry_indexes(conn)
+    
+    # Ranges of whole coffees with about REBUILD_CHUNK_SIZE entries each
+    bounds, entries = [], 0
+    for coffee_id, entry_count in conn.execute('SELECT id, entry_count FROM coffee ORDER BY id'):
+        entries += entry_count
+        if entries >= REBUILD_CHUNK_SIZE:
+            bounds.append(coffee_id)
+            entries = 0
+    
+    def next_id(last_id):
+        i = bisect.bisect_right(bounds, last_id)
+        return bounds[i] if i < len(bounds) else 2 ** 63 - 1
+    
+    def start(conn):
+        if not _create_coffee_stats(conn.cursor()):
+            return None
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM coffee').fetchone()[0]
+    
+    backfill(conn, 'coffee_stats', start,
+             lambda conn, first, last: database.rebuild_coffee_stats(conn, (first, last)),
+             next_id=next_id)
+
+
+def _create_coffee_stats(cursor: sqlite3.Cursor) -> bool:
+    """Create the coffee_stats and coffee_grinder_count tables (empty).
+    Returns whether they were new."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'coffee_stats'")
+    stats_exist = cursor.fetchone() is not None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS coffee_stats (
+            coffee_id INTEGER PRIMARY KEY,
+            entry_count INTEGER NOT NULL DEFAULT 0,
+            ratio_mean REAL, ratio_m2 REAL, ratio_min REAL, ratio_max REAL,
+            input_mean REAL, input_m2 REAL, input_min REAL, input_max REAL,
+            output_mean REAL, output_m2 REAL, output_min REAL, output_max REAL,
+            FOREIGN KEY (coffee_id) REFERENCES coffee(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS coffee_grinder_count (
+            coffee_id INTEGER NOT NULL,
+            grinder_setting TEXT NOT NULL,
+            entry_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (coffee_id, grinder_setting),
+            FOREIGN KEY (coffee_id) REFERENCES coffee(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_coffee_grinder_count_rank
+        ON coffee_grinder_count(coffee_id, entry_count)
+    ''')
+    return not stats_exist
+
+
+def add_login_bucket(conn: sqlite3.Connection):
+    """Add login throttling buckets."""
+    cursor = conn.cursor()
+    
+    # Token buckets for login throttling, when shared across workers (see ratelimit.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS login_bucket (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+
+def add_email_outbox(conn: sqlite3.Connection):
+    """Add the email outbox."""
+    cursor = conn.cursor()
+    
+    # Outgoing email, sent in the background (see outbox.py). next_attempt_at is
+    # when a pending message is due (also used as the lease while it's being
+    # sent); it is NULL once the message has failed for good.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_email_outbox_pending
+        ON email_outbox(next_attempt_at) WHERE sent_at IS NULL
+    ''')
+
+
+def add_search_index(conn: sqlite3.Connection):
+    """Add the full-text search index."""
+    cursor = conn.cursor()
+    
+    # Full-text index over coffee name, grinder setting and taste comment,
+    # keyed by entry id and kept in sync by triggers. fill_search_index has
+    # filled it already, unless the migration runs without its copy phase.
+    if _create_search_index(cursor):
+        _fill_search_index(conn)
+
+
+def fill_search_index(conn: sqlite3.Connection):
+    """Create the full-text search index and fill it a range of entries at a
+    time (for migration 9)."""
+    def start(conn):
+        if not _create_search_index(conn.cursor()):
+            return None
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM espresso_entry').fetchone()[0]
+    
+    backfill(conn, 'entry_fts', start, _fill_search_index)
+
+
+def _fill_search_index(conn: sqlite3.Connection, first: int = 0, last: int = 2 ** 63 - 1):
+    """Index the entries with ids from first to last. Replaces rows the sync
+    triggers already wrote, so it can run while the app keeps writing."""
+    conn.execute('''
+        INSERT OR REPLACE INTO entry_fts (rowid, coffee, grinder_setting, taste_comment)
+        SELECT e.id, c.name, e.grinder_setting, e.taste_comment
+        FROM espresso_entry e
+        JOIN coffee c ON c.id = e.coffee_id
+        WHERE e.id BETWEEN ? AND ?
+    ''', (first, last))
+
+
+def add_entry_indexes(conn: sqlite3.Connection):
+    """Add the composite entry indexes."""
+    cursor = conn.cursor()
+    
+    # Create indexes for performance (already there if create_entry_indexes
+    # or migration 3 made them)
+    for name, columns in ENTRY_INDEXES.items():
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON espresso_entry({columns})')
+    
+    # Single-column indexes made redundant by the composites above
+    # (and the UNIQUE constraint on user.email)
+    cursor.execute('DROP INDEX IF EXISTS idx_espresso_entry_user_id')
+    cursor.execute('DROP INDEX IF EXISTS idx_espresso_entry_coffee')
+    cursor.execute('DROP INDEX IF EXISTS idx_user_email')
+
+
+def create_entry_indexes(conn: sqlite3.Connection):
+    """Create the missing ENTRY_INDEXES, each in its own transaction (for
+    migrations 4, 6 and 10). Backfills run after it, so they look entries up
+    by coffee instead of scanning the table for every coffee."""
+    for name, columns in ENTRY_INDEXES.items():
+        database.begin_immediate(conn)
+        try:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON espresso_entry({columns})')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def drop_unused_indexes(conn: sqlite3.Connection):
+    """Drop entry indexes no query uses."""
+    cursor = conn.cursor()
+    
+    # get_user_and_anonymous_entries_by_coffee is served by (coffee_id, created_at)
+    cursor.execute('DROP INDEX IF EXISTS idx_espresso_entry_coffee_user_created')
+    # Ratio filters and sorts are always within one coffee: (coffee_id, extraction_ratio)
+    cursor.execute('DROP INDEX IF EXISTS idx_espresso_entry_ratio')
+
+
+def _create_search_index(cursor: sqlite3.Cursor) -> bool:
+    """Create the entry_fts table (empty) and its sync triggers.
+    Returns whether the table was new; raises MigrationSkipped without FTS5."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entry_fts'")
+    search_exists = cursor.fetchone() is not None
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS entry_fts USING fts5(
+                coffee, grinder_setting, taste_comment,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        raise MigrationSkipped(f'Full-text search unavailable (SQLite built without FTS5?): {e}')
+    if not search_exists:
+        # Rank coffee name matches above grinder settings above comments
+        cursor.execute("INSERT INTO entry_fts (entry_fts, rank) VALUES ('rank', 'bm25(5.0, 2.0, 1.0)')")
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_entry_fts_insert
+        AFTER INSERT ON espresso_entry
+        BEGIN
+            INSERT INTO entry_fts (rowid, coffee, grinder_setting, taste_comment)
+            SELECT NEW.id, name, NEW.grinder_setting, NEW.taste_comment
+            FROM coffee WHERE id = NEW.coffee_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_entry_fts_update
+        AFTER UPDATE OF coffee_id, grinder_setting, taste_comment ON espresso_entry
+        BEGIN
+            DELETE FROM entry_fts WHERE rowid = OLD.id;
+            INSERT INTO entry_fts (rowid, coffee, grinder_setting, taste_comment)
+            SELECT NEW.id, name, NEW.grinder_setting, NEW.taste_comment
+            FROM coffee WHERE id = NEW.coffee_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_entry_fts_delete
+        AFTER DELETE ON espresso_entry
+        BEGIN
+            DELETE FROM entry_fts WHERE rowid = OLD.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_entry_fts_coffee_rename
+        AFTER UPDATE OF name ON coffee
+        BEGIN
+            UPDATE entry_fts SET coffee = NEW.name
+            WHERE rowid IN (SELECT id FROM espresso_entry WHERE coffee_id = NEW.id);
+        END
+    ''')
+    return not search_exists
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    """Return the names of table's columns, generated ones included."""
+    return [row[1] for row in conn.execute(f'PRAGMA table_xinfo({table})').fetchall()]
+
+
+def _indexes(conn: sqlite3.Connection, table: str) -> List[Tuple[str, str]]:
+    """Return (name, sql) of table's explicitly created indexes."""
+    return [tuple(row) for row in conn.execute('''
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL
+    ''', (table,)).fetchall()]
+
+
+def _index_sql(sql: str, name: str, new_name: str, table: str, new_table: str) -> str:
+    """Rewrite a CREATE INDEX statement to create new_name on new_table."""
+    return re.sub(rf'\bINDEX\s+["`]?{name}["`]?\s+ON\s+["`]?{table}["`]?',
+                  f'INDEX {new_name} ON {new_table}', sql, count=1, flags=re.IGNORECASE)
+
+
+def _rebuild_progress(table: str, last_id: int, max_id: int):
+    logger.info('Rebuilding %s: copied ids up to %s of %s', table, last_id, max_id)
+
+
+def _create_rebuild_table(conn: sqlite3.Connection):
+    """Create the table_rebuild table, where copies and backfills keep their progress."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS table_rebuild (
+            table_name TEXT PRIMARY KEY,
+            definition TEXT NOT NULL,
+            last_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL
+        )
+    ''')
+
+
+def _rebuild_state(conn: sqlite3.Connection, table: str) -> Optional[Tuple]:
+    """Return (definition, last_id, max_id) of table's copy or backfill, if one is underway."""
+    try:
+        return conn.execute('SELECT definition, last_id, max_id FROM table_rebuild '
+                            'WHERE table_name = ?', (table,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+
+def _finish_rebuild(conn: sqlite3.Connection, table: str):
+    """Forget table's progress, dropping table_rebuild once nothing is left in it."""
+    conn.execute('DELETE FROM table_rebuild WHERE table_name = ?', (table,))
+    if conn.execute('SELECT 1 FROM table_rebuild LIMIT 1').fetchone() is None:
+        conn.execute('DROP TABLE table_rebuild')
+
+
+def _copy_chunks(conn: sqlite3.Connection, table: str, last_id: int, max_id: int,
+                 fill: Callable[[sqlite3.Connection, int, int], None],
+                 next_id: Callable[[int], int],
+                 progress: Optional[Callable[[str, int, int], None]]):
+    """Run fill(conn, first, last) over the ids after last_id up to max_id in
+    ranges ending at next_id(last_id), each in its own transaction with its
+    progress row."""
+    while last_id < max_id:
+        upper = min(next_id(last_id), max_id)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            fill(conn, last_id + 1, upper)
+            conn.execute('UPDATE table_rebuild SET last_id = ? WHERE table_name = ?',
+                         (upper, table))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        last_id = upper
+        if progress:
+            progress(table, last_id, max_id)
+
+
+def copy_table(conn: sqlite3.Connection, table: str, create_sql: str, columns: Dict[str, str],
+               join: str = '', trigger_prelude: str = '',
+               indexes: Optional[Dict[str, str]] = None,
+               chunk_size: int = REBUILD_CHUNK_SIZE,
+               progress: Optional[Callable[[str, int, int], None]] = _rebuild_progress):
+    """Copy table into {table}_new in a new definition without holding the write lock
+    for the copy; swap_table then puts the copy in place.
+
+    create_sql is a CREATE TABLE template with a {table} placeholder. columns maps
+    each new column to an expression over the old table (aliased ``e``, plus any
+    tables in join). Rows are copied in id ranges of chunk_size, each in its own
+    short transaction, while triggers on the old table keep copied rows in sync
+    with concurrent writes; trigger_prelude is SQL run first in those triggers.
+    The table's indexes, or those in indexes (name: columns) if given, are
+    created on the empty copy (as {index}_new) and filled chunk by chunk, so
+    swap_table only has to rename them.
+    Progress is kept in the table_rebuild table, so an interrupted copy resumes
+    where it stopped.
+
+    Commits as it goes, so conn must not have a transaction open (RuntimeError
+    otherwise). In a migration, run it from the migration's COPY_PHASES entry.
+    """
+    new_table = f'{table}_new'
+    names = ', '.join(columns)
+    select = f"SELECT {', '.join(columns.values())} FROM {table} e {join}"
+    
+    # Create the new table and the sync triggers, and note the last id to copy:
+    # rows inserted after this transaction reach the new table through the triggers
+    database.begin_immediate(conn)
+    try:
+        _create_rebuild_table(conn)
+        definition = create_sql.format(table=new_table)
+        row = _rebuild_state(conn, table)
+        if row is not None and row[0] == definition:
+            last_id, max_id = row[1], row[2]
+        else:
+            # Start over, also when an interrupted copy was for another definition
+            conn.execute(f'DROP TABLE IF EXISTS {new_table}')
+            conn.execute(definition)
+            if indexes is None:
+                for name, sql in _indexes(conn, table):
+                    conn.execute(_index_sql(sql, name, f'{name}_new', table, new_table))
+            else:
+                for name, index_columns in indexes.items():
+                    conn.execute(f'CREATE INDEX {name}_new ON {new_table}({index_columns})')
+            copy = f'INSERT OR REPLACE INTO {new_table} ({names}) {select} WHERE e.id = NEW.id;'
+            for event, statements in (('insert', trigger_prelude + copy),
+                                      ('update', f'{trigger_prelude} DELETE FROM {new_table} '
+                                                 f'WHERE id = OLD.id; {copy}'),
+                                      ('delete', f'DELETE FROM {new_table} WHERE id = OLD.id;')):
+                conn.execute(f'DROP TRIGGER IF EXISTS {table}_rebuild_{event}')
+                conn.execute(f'''
+                    CREATE TRIGGER {table}_rebuild_{event} AFTER {event.upper()} ON {table}
+                    BEGIN {statements} END
+                ''')
+            last_id = 0
+            max_id = conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+            conn.execute('''
+                INSERT OR REPLACE INTO table_rebuild (table_name, definition, last_id, max_id)
+                VALUES (?, ?, ?, ?)
+            ''', (table, definition, last_id, max_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    # Copy in id ranges, releasing the write lock between chunks
+    def copy(conn, first, last):
+        conn.execute(f'INSERT OR REPLACE INTO {new_table} ({names}) {select} '
+                     'WHERE e.id BETWEEN ? AND ?', (first, last))
+    
+    _copy_chunks(conn, table, last_id, max_id, copy, lambda last_id: last_id + chunk_size,
+                 progress)
+
+
+def backfill(conn: sqlite3.Connection, table: str,
+             start: Callable[[sqlite3.Connection], Optional[int]],
+             fill: Callable[[sqlite3.Connection, int, int], None],
+             chunk_size: int = REBUILD_CHUNK_SIZE,
+             progress: Optional[Callable[[str, int, int], None]] = _rebuild_progress,
+             next_id: Optional[Callable[[int], int]] = None):
+    """Fill a new table from existing rows without holding the write lock for
+    the whole fill.
+
+    start(conn) runs first, under the write lock: it creates the table, and
+    whatever keeps it current for rows written from then on, and returns the
+    last id to fill (None if the table was there already). fill(conn, first,
+    last) then fills ids first to last in ranges of chunk_size, each in its own
+    short transaction; next_id(last_id), if given, picks where each range ends
+    instead. Progress is kept in the table_rebuild table, so an interrupted
+    backfill resumes where it stopped.
+
+    Commits as it goes, so conn must not have a transaction open (RuntimeError
+    otherwise). In a migration, run it from the migration's COPY_PHASES entry.
+    """
+    database.begin_immediate(conn)
+    try:
+        row = _rebuild_state(conn, table)
+        if row is not None:
+            last_id, max_id = row[1], row[2]
+        else:
+            last_id, max_id = 0, start(conn)
+            if max_id is not None:
+                _create_rebuild_table(conn)
+                conn.execute('''
+                    INSERT INTO table_rebuild (table_name, definition, last_id, max_id)
+                    VALUES (?, 'backfill', ?, ?)
+                ''', (table, last_id, max_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if max_id is None:
+        return
+    
+    _copy_chunks(conn, table, last_id, max_id, fill,
+                 next_id or (lambda last_id: last_id + chunk_size), progress)
+    database.begin_immediate(conn)
+    try:
+        _finish_rebuild(conn, table)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def swap_table(conn: sqlite3.Connection, table: str, recreate: bool = True):
+    """Replace table with the finished copy made by copy_table.
+
+    Runs inside the caller's transaction, which must hold the write lock (BEGIN
+    IMMEDIATE), and doesn't commit. Drops the old table and renames the copy into
+    place; the indexes built on the copy by copy_table lose their _new suffix.
+    With recreate, the old table's triggers, any index without a copy, and other
+    triggers and views referring to the table are recreated.
+    """
+    new_table = f'{table}_new'
+    row = _rebuild_state(conn, table)
+    if row is None or row[1] < row[2]:
+        raise RuntimeError(f'{table} has no finished copy to swap in: run copy_table first')
+    
+    prebuilt = []
+    for copy, sql in _indexes(conn, new_table):
+        name = copy[:-len('_new')]
+        prebuilt.append((name, _index_sql(sql, copy, name, new_table, table)))
+    built = {name for name, _ in prebuilt}
+    owned = [sql for name, sql in conn.execute('''
+        SELECT name, sql FROM sqlite_master
+        WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL
+    ''', (table,)).fetchall()
+             if not name.startswith(f'{table}_rebuild_') and name not in built]
+    # Other tables' triggers (and views) that refer to the table would make
+    # the rename fail, so they're dropped for the swap
+    dependent = [(kind, name, sql) for kind, name, sql in conn.execute('''
+        SELECT type, name, sql FROM sqlite_master
+        WHERE type IN ('trigger', 'view') AND tbl_name != ?
+    ''', (table,)).fetchall() if re.search(rf'\b{table}\b', sql)]
+    for kind, name, _ in dependent:
+        conn.execute(f'DROP {kind.upper()} {name}')
+    
+    sequence = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?',
+                            (table,)).fetchone()
+    conn.execute(f'DROP TABLE {table}')
+    conn.execute(f'ALTER TABLE {new_table} RENAME TO {table}')
+    if sequence is not None:
+        # Don't hand out the ids of rows deleted from the end of the old table
+        conn.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?',
+                     (sequence[0], table))
+    if prebuilt:
+        # SQLite can't rename an index, so rename the copies in the schema table
+        # directly and bump the schema version so every connection reloads it
+        # (see "Making Other Kinds Of Table Schema Changes" in the ALTER TABLE docs)
+        version = conn.execute('PRAGMA schema_version').fetchone()[0]
+        conn.execute('PRAGMA writable_schema = ON')
+        try:
+            for name, sql in prebuilt:
+                conn.execute("UPDATE sqlite_master SET name = ?, sql = ? "
+                             "WHERE type = 'index' AND name = ?", (name, sql, f'{name}_new'))
+            conn.execute(f'PRAGMA schema_version = {version + 1}')
+        finally:
+            conn.execute('PRAGMA writable_schema = OFF')
+    if recreate:
+        for sql in owned + [sql for _, _, sql in dependent]:
+            conn.execute(sql)
+    
+    _finish_rebuild(conn, table)
+    logger.info('Rebuilt %s', table)
+
+
+MIGRATIONS = [
+    (1, create_tables),
+    (2, add_entry_user_id),
+    (3, rebuild_entry_table),
+    (4, add_coffee_triggers),
+    (5, add_change_counter),
+    (6, add_coffee_stats),
+    (7, add_login_bucket),
+    (8, add_email_outbox),
+    (9, add_search_index),
+    (10, add_entry_indexes),
+    (11, drop_unused_indexes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Table copies and backfills run before a migration's own transaction, for
+# migrations that rebuild or fill a table (see copy_table, swap_table and
+# backfill), so they don't hold the write lock for their whole run. They run
+# again if the migration fails, so they must be safe to repeat.
+COPY_PHASES = {
+    2: copy_entry_user_id,
+    3: copy_entry_table,
+    4: create_entry_indexes,
+    6: fill_coffee_stats,
+    9: fill_search_index,
+    10: create_entry_indexes,
+}
+
+
+class MigrationSkipped(Exception):
+    """Raised by a migration that can't be applied to this database yet.
+    upgrade() rolls it back and leaves it pending."""
+
+
+def current_version(conn: Optional[sqlite3.Connection] = None) -> int:
+    """Return the schema version recorded in the database (0 if none)."""
+    with database.connection(conn) as conn:
+        try:
+            row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+        except sqlite3.OperationalError:
+            return 0
+    return row[0] or 0
+
+
+def pending_versions(conn: Optional[sqlite3.Connection] = None) -> List[int]:
+    """Return the versions of the migrations not recorded in the database."""
+    with database.connection(conn) as conn:
+        try:
+            rows = conn.execute('SELECT version FROM schema_version').fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+    recorded = {row[0] for row in rows}
+    return [version for version, _ in MIGRATIONS if version not in recorded]
+
+
+def upgrade(conn: Optional[sqlite3.Connection] = None) -> List[int]:
+    """Apply pending migrations in order. Returns the versions applied.
+    Each migration commits together with its schema_version row in one
+    transaction under the write lock, so concurrent upgrades apply it only once
+    and a failed migration leaves nothing behind. Its COPY_PHASES entry runs
+    first in chunked transactions of its own, so run one upgrade at a time.
+    """
+    applied = []
+    with database.connection(conn) as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+        
+        pending = pending_versions(conn)
+        for version, migration in MIGRATIONS:
+            if version not in pending:
+                continue
+            try:
+                if version in COPY_PHASES:
+                    COPY_PHASES[version](conn)
+                database.begin_immediate(conn)
+                if conn.execute('SELECT 1 FROM schema_version WHERE version = ?',
+                                (version,)).fetchone():
+                    conn.rollback()
+                    continue
+                migration(conn)
+                if not conn.in_transaction:
+                    raise RuntimeError(f'Migration {version} committed its own transaction')
+                conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                             (version, migration.__doc__.strip()))
+                conn.commit()
+            except MigrationSkipped as e:
+                conn.rollback()
+                logger.warning('Skipped migration %s, it stays pending: %s', version, e)
+                continue
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info('Applied migration %s: %s', version, migration.__doc__.strip())
+            applied.append(version)
+    return applied
+
+
+def check(conn: Optional[sqlite3.Connection] = None) -> int:
+    """Warn if the database needs migrations; called at worker startup.
+    Also warns if the connection PRAGMA profile didn't take effect (e.g. WAL is
+    unavailable on some filesystems). Returns the number of pending migrations.
+    """
+    with database.connection(conn) as conn:
+        pending = pending_versions(conn)
+        if pending:
+            logger.warning('Database schema is at version %s with migrations %s pending: '
+                           'run `flask db-upgrade`', current_version(conn),
+                           ', '.join(map(str, pending)))
+        for name, (expected, actual) in database.verify_pragmas(conn).items():
+            logger.warning('PRAGMA %s is %r, expected %r', name, actual, expected)
+    return len(pending)
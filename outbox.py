@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+
+from flask_mail import Message
+
+import database
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+# Seconds a claimed email is reserved for the sender before it's retried
+LEASE = 300
+MAX_ATTEMPTS = 8
+# Retry after BACKOFF_BASE * 2 ** (attempts - 1) seconds, at most BACKOFF_MAX
+BACKOFF_BASE = 30
+BACKOFF_MAX = 3600
+
+
+def enqueue(recipient: str, subject: str, body: str) -> int:
+    """Queue an email for the sender and wake it if it runs in this process."""
+    email_id = database.enqueue_email(recipient, subject, body, time.time())
+    if _sender is not None:
+        _sender.wake()
+    return email_id
+
+
+def retry_delay(attempts: int) -> float:
+    """Seconds to wait before the next attempt after attempts failures."""
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+def send_due(mail, batch_size: int = BATCH_SIZE) -> int:
+    """Send the emails that are due over one SMTP connection.
+    Must run inside an app context. Returns how many were sent.
+    """
+    emails = database.claim_due_emails(time.time(), LEASE, batch_size)
+    if not emails:
+        return 0
+
+    sent = 0
+    # Emails not yet handed to SMTP; each leaves before its attempt
+    pending = {email['id']: email for email in emails}
+    failure = None
+    try:
+        with mail.connect() as smtp:
+            for email in emails:
+                del pending[email['id']]
+                try:
+                    smtp.send(Message(subject=email['subject'], recipients=[email['recipient']],
+                                      body=email['body']))
+                except Exception as e:
+                    _record_failure(email, e)
+                    continue
+                database.mark_email_sent(email['id'])
+                sent += 1
+    except Exception as e:
+        # Connecting (or the connection) failed: retry the emails never attempted
+        failure = e
+
+    if failure is not None:
+        for email in pending.values():
+            _record_failure(email, failure)
+    return sent
+
+
+def _record_failure(email, error):
+    attempts = email['attempts'] + 1
+    retry_at = time.time() + retry_delay(attempts) if attempts < MAX_ATTEMPTS else None
+    database.mark_email_failed(email['id'], str(error), retry_at)
+    logger.warning('Email %s to %s failed (attempt %s): %s', email['id'],
+                   email['recipient'], attempts, error)
+
+
+class Sender(threading.Thread):
+    """Background thread sending due emails every interval seconds, or when woken."""
+
+    def __init__(self, app, mail, interval: float = 10):
+        super().__init__(name='email-outbox', daemon=True)
+        self.app = app
+        self.mail = mail
+        self.interval = interval
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    while send_due(self.mail) == BATCH_SIZE:
+                        pass
+            except Exception:
+                logger.exception('Email outbox sender failed')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def start_sender(app, mail, interval: float = 10) -> Sender:
+    """Start this process's sender thread (once)."""
+    global _sender
+    if _sender is not None and _sender.is_alive():
+        return _sender
+    with _sender_lock:
+        if _sender is None or not _sender.is_alive():
+            _sender = Sender(app, mail, interval)
+            _sender.start()
+        return _sender
@@ -0,0 +1,111 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict
+
+from werkzeug.security import (DEFAULT_PBKDF2_ITERATIONS, check_password_hash,
+                               generate_password_hash)
+
+
+# Hash method including its cost, in werkzeug's format (e.g. pbkdf2:sha256:600000).
+# Stored hashes made with a different method are upgraded on the next login.
+HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+
+# Hashing runs in this many worker processes (0 hashes in the calling thread)
+HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+# Most hashes queued or running at once; further requests fail fast with HashingBusy
+HASH_QUEUE_SIZE = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE', 8))
+
+
+class HashingBusy(RuntimeError):
+    """Raised when the hashing queue is full."""
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(HASH_QUEUE_SIZE, 1))
+
+# Per-operation latency totals: op -> [count, total seconds, max seconds]
+_latency: Dict[str, list] = {'hash': [0, 0.0, 0.0], 'check': [0, 0.0, 0.0]}
+_latency_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Return this process's hashing pool, starting it on first use (and after a fork)."""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            # forkserver workers don't inherit the app's threads, locks or sqlite connections
+            _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS,
+                                            mp_context=multiprocessing.get_context('forkserver'))
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _discard_executor(executor: ProcessPoolExecutor):
+    """Drop a broken pool so the next _get_executor starts a fresh one."""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def _run(op: str, func, *args):
+    """Run func(*args) in the hashing pool, recording its latency under op."""
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy('Too many password operations in progress, please try again')
+    start = time.perf_counter()
+    try:
+        if HASH_WORKERS == 0:
+            return func(*args)
+        executor = _get_executor()
+        try:
+            return executor.submit(func, *args).result()
+        except BrokenProcessPool:
+            # A worker died (OOM kill, crash); hashing is pure, so retry once on a new pool
+            _discard_executor(executor)
+            return _get_executor().submit(func, *args).result()
+    finally:
+        _slots.release()
+        elapsed = time.perf_counter() - start
+        with _latency_lock:
+            stats = _latency[op]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+
+def hash_password(password: str) -> str:
+    """Hash a password with the configured method."""
+    return _run('hash', generate_password_hash, password, HASH_METHOD, SALT_LENGTH)
+
+
+def check_password(password_hash: str, password: str) -> bool:
+    """Check a password against a stored hash."""
+    return _run('check', check_password_hash, password_hash, password)
+
+
+def _stored_method(method: str) -> str:
+    """Return a hash method as werkzeug writes it at the start of a hash, with
+    pbkdf2's default iteration count filled in when the method leaves it out."""
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        return f'{method}:{DEFAULT_PBKDF2_ITERATIONS}'
+    return method
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """Whether a stored hash was made with a different method or cost than configured."""
+    return password_hash.split('$', 1)[0] != _stored_method(HASH_METHOD)
+
+
+def latency_metrics() -> Dict[str, Dict[str, float]]:
+    """Return {op: {count, total_seconds, max_seconds}} for hash and check."""
+    with _latency_lock:
+        return {op: {'count': count, 'total_seconds': total, 'max_seconds': longest}
+                for op, (count, total, longest) in _latency.items()}
@@ -0,0 +1,130 @@
+import sqlite3
+import time
+from typing import Dict, Optional, Tuple
+
+
+class QueryStats:
+    """SQL statements run during one request: count, total seconds and the slowest."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_sql = None
+        self.executions: Dict[str, int] = {}  # sql -> times run
+
+    def add(self, sql: str, elapsed: float):
+        """Count a run of sql that took elapsed seconds."""
+        self.count += 1
+        executions = self.executions
+        executions[sql] = executions.get(sql, 0) + 1
+        self.total += elapsed
+        if elapsed > self.slowest:
+            self.slowest, self.slowest_sql = elapsed, sql
+
+    def add_time(self, sql: str, elapsed: float, statement_elapsed: float):
+        """Add time spent on a statement (e.g. fetching its rows), which has
+        taken statement_elapsed seconds in total so far.
+        """
+        self.total += elapsed
+        if statement_elapsed > self.slowest:
+            self.slowest, self.slowest_sql = statement_elapsed, sql
+
+    def most_repeated(self) -> Tuple[Optional[str], int]:
+        """The statement run most often and how many times."""
+        if not self.executions:
+            return None, 0
+        sql = max(self.executions, key=self.executions.get)
+        return sql, self.executions[sql]
+
+
+_perf_counter = time.perf_counter
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor adding each statement's execute and fetch time to its connection's
+    QueryStats. InstrumentedConnection only hands them out while it has stats.
+    fetchone() isn't timed: execute() already steps to the first row, which is
+    all most fetchone() callers read.
+    """
+
+    _sql = None
+    _elapsed = 0.0
+
+    def execute(self, sql, parameters=()):
+        start = _perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._sql = sql
+            self._elapsed = elapsed = _perf_counter() - start
+            stats = self.connection.stats
+            if stats is not None:
+                stats.add(sql, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = _perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._sql = sql
+            self._elapsed = elapsed = _perf_counter() - start
+            stats = self.connection.stats
+            if stats is not None:
+                stats.add(sql, elapsed)
+
+    def fetchmany(self, size=None):
+        start = _perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            elapsed = _perf_counter() - start
+            stats = self.connection.stats
+            if stats is not None and self._sql is not None:
+                self._elapsed += elapsed
+                stats.add_time(self._sql, elapsed, self._elapsed)
+
+    def fetchall(self):
+        start = _perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            elapsed = _perf_counter() - start
+            stats = self.connection.stats
+            if stats is not None and self._sql is not None:
+                self._elapsed += elapsed
+                stats.add_time(self._sql, elapsed, self._elapsed)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection recording its statements and commits in ``stats`` when set.
+    database.get_request_db() sets it to the request's QueryStats; without stats it
+    hands out plain cursors, so pooled connections outside requests pay nothing.
+    """
+
+    stats: Optional[QueryStats] = None
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = sqlite3.Cursor if self.stats is None else InstrumentedCursor
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        if self.stats is None:
+            return super().execute(sql, parameters)
+        return super().cursor(InstrumentedCursor).execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if self.stats is None:
+            return super().executemany(sql, seq_of_parameters)
+        return super().cursor(InstrumentedCursor).executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        stats = self.stats
+        if stats is None:
+            return super().commit()
+        start = _perf_counter()
+        try:
+            super().commit()
+        finally:
+            stats.add('COMMIT', _perf_counter() - start)
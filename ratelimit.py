@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+import database
+
+
+class MemoryBuckets:
+    """Token buckets kept in this process.
+
+    Buckets start full with ``capacity`` tokens and refill at ``refill_rate``
+    tokens per second. At most ``max_keys`` buckets are tracked; the least
+    recently used are forgotten (which refills them).
+    """
+
+    def __init__(self, capacity: float, refill_rate: float, max_keys: int = 10000):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, key: str) -> Tuple[bool, float]:
+        """Take a token for key. Returns (allowed, tokens left)."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated_at) * self.refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, tokens
+
+
+class SQLiteBuckets:
+    """Token buckets stored in the login_bucket table, shared by all worker processes."""
+
+    # Rows untouched this long are full again; prune them every so many takes
+    PRUNE_EVERY = 1000
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._takes = 0
+
+    def take(self, key: str) -> Tuple[bool, float]:
+        """Take a token for key. Returns (allowed, tokens left)."""
+        now = time.time()
+        self._takes += 1
+        if self._takes % self.PRUNE_EVERY == 0 and self.refill_rate > 0:
+            database.prune_buckets(now - self.capacity / self.refill_rate)
+        return database.take_bucket_token(key, self.capacity, self.refill_rate, now)
+
+
+class LoginLimiter:
+    """Throttle login attempts per client IP and per email address."""
+
+    def __init__(self, backend: str = 'memory', ip_burst: int = 20, ip_per_minute: float = 10,
+                 email_burst: int = 5, email_per_minute: float = 2):
+        buckets = SQLiteBuckets if backend == 'sqlite' else MemoryBuckets
+        self.by_ip = buckets(ip_burst, ip_per_minute / 60)
+        self.by_email = buckets(email_burst, email_per_minute / 60)
+
+    def allow(self, ip: str, email: str) -> bool:
+        """Take a token for the IP, then for the email. False if either is exhausted."""
+        allowed, _ = self.by_ip.take(f'ip:{ip}')
+        if not allowed:
+            return False
+        if email:
+            allowed, _ = self.by_email.take(f'email:{email}')
+        return allowed
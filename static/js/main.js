@@ -181,3 +181,65 @@ document.addEventListener('DOMContentLoaded', function() {
         }, 5000);
     });
 });
+
+// Infinite scroll for paginated entry feeds
+document.addEventListener('DOMContentLoaded', function() {
+    setupLoadMore(document);
+});
+
+function setupLoadMore(root) {
+    root.querySelectorAll('.load-more a[data-feed-url]').forEach(function(link) {
+        link.addEventListener('click', function(e) {
+            e.preventDefault();
+            loadMoreEntries(link);
+        });
+
+        // Load the next page automatically when the link scrolls into view
+        if ('IntersectionObserver' in window) {
+            const observer = new IntersectionObserver(function(items) {
+                if (items.some(item => item.isIntersecting)) {
+                    observer.disconnect();
+                    loadMoreEntries(link);
+                }
+            }, { rootMargin: '200px' });
+            observer.observe(link);
+        }
+    });
+}
+
+function loadMoreEntries(link) {
+    if (link.dataset.loading) {
+        return;
+    }
+    link.dataset.loading = 'true';
+
+    const container = link.closest('.load-more');
+    const grid = document.getElementById(link.dataset.target);
+
+    fetch(link.dataset.feedUrl)
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error('Failed to load entries');
+            }
+            return response.text();
+        })
+        .then(function(html) {
+            const fragment = document.createElement('template');
+            fragment.innerHTML = html;
+            fragment.content.querySelectorAll('.entry-card').forEach(function(card) {
+                grid.appendChild(card);
+            });
+
+            const next = fragment.content.querySelector('.load-more');
+            if (next) {
+                container.replaceWith(next);
+                setupLoadMore(next);
+            } else {
+                container.remove();
+            }
+        })
+        .catch(function() {
+            // Fall back to a full page load
+            window.location.href = link.href;
+        });
+}
@@ -0,0 +1,93 @@
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import unittest
+
+import database
+import migrations
+
+
+class CoffeeStatsTest(unittest.TestCase):
+    """The incremental coffee_stats rollup matches a full recomputation."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.conn = sqlite3.connect(os.path.join(self.tmp.name, 'test.db'))
+        self.conn.row_factory = sqlite3.Row
+        migrations.upgrade(self.conn)
+        self.conn.execute("INSERT INTO user (id, email, password_hash) VALUES (1, 'a@x.io', 'x')")
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def expected(self, coffee):
+        rows = self.conn.execute('''
+            SELECT e.extraction_ratio, e.input_weight, e.output_weight
+            FROM espresso_entry e JOIN coffee c ON c.id = e.coffee_id
+            WHERE c.name = ?
+        ''', (coffee,)).fetchall()
+        expected = {'count': len(rows)}
+        for index, prefix in enumerate(('ratio', 'input', 'output')):
+            values = [row[index] for row in rows]
+            expected[prefix] = {
+                'mean': statistics.fmean(values),
+                'stddev': statistics.stdev(values) if len(values) > 1 else 0.0,
+                'min': min(values),
+                'max': max(values),
+            }
+        return expected
+
+    def assertStatsMatch(self, coffee):
+        actual = database.get_coffee_stats(coffee, conn=self.conn)
+        expected = self.expected(coffee)
+        self.assertEqual(actual['count'], expected['count'])
+        for prefix in ('ratio', 'input', 'output'):
+            for key, value in expected[prefix].items():
+                self.assertAlmostEqual(actual[prefix][key], value, delta=1e-9 * max(1, abs(value)),
+                                       msg=f'{coffee} {prefix} {key}')
+
+    def test_incremental_matches_recomputation(self):
+        rng = random.Random(1)
+        coffees = ['Kenya', 'Brazil']
+        ids = []
+        for _ in range(60):
+            input_weight = round(rng.uniform(16, 20), 1)
+            ids.append(database.add_entry(1, rng.choice(coffees), str(rng.randint(5, 15)),
+                                          input_weight, round(input_weight * rng.uniform(1.5, 3), 1),
+                                          conn=self.conn))
+        # Updates, including moving entries between coffees and new extremes
+        for entry_id in ids[:15]:
+            database.update_entry(entry_id, 1, rng.choice(coffees), '9',
+                                  round(rng.uniform(10, 25), 1), round(rng.uniform(20, 60), 1),
+                                  conn=self.conn)
+        for entry_id in ids[15:35]:
+            database.delete_entry(entry_id, 1, conn=self.conn)
+
+        for coffee in coffees:
+            self.assertStatsMatch(coffee)
+        incremental = {coffee: database.get_coffee_stats(coffee, conn=self.conn)
+                       for coffee in coffees}
+        database.rebuild_coffee_stats(self.conn)
+        for coffee in coffees:
+            self.assertStatsMatch(coffee)
+            rebuilt = database.get_coffee_stats(coffee, conn=self.conn)
+            self.assertEqual(rebuilt['common_grinder'], incremental[coffee]['common_grinder'])
+
+    def test_rebuild_is_accurate_for_large_values(self):
+        # Sum of squares minus squared sum loses every digit of the variance here
+        for offset in (0.0, 0.1, 0.2, 0.3):
+            database.add_entry(1, 'Heavy', '9', 1e8 + offset, 2e8, conn=self.conn)
+        incremental = database.get_coffee_stats('Heavy', conn=self.conn)
+        database.rebuild_coffee_stats(self.conn)
+        rebuilt = database.get_coffee_stats('Heavy', conn=self.conn)
+        expected = statistics.stdev([1e8, 1e8 + 0.1, 1e8 + 0.2, 1e8 + 0.3])
+        self.assertAlmostEqual(incremental['input']['stddev'], expected, places=6)
+        self.assertAlmostEqual(rebuilt['input']['stddev'], expected, places=6)
+
+
+if __name__ == '__main__':
+    unittest.main()
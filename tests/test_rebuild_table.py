@@ -0,0 +1,205 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import migrations
+
+
+COLUMNS = {column: f'e.{column}' for column in (
+    'id', 'user_id', 'coffee_id', 'grinder_setting', 'input_weight', 'output_weight',
+    'taste_comment', 'created_at', 'updated_at',
+)}
+
+
+class RebuildTableTest(unittest.TestCase):
+    """copy_table and swap_table keep every row and index while the app writes."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.db')
+        self.conn = self.connect()
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        migrations.upgrade(self.conn)
+        self.conn.execute("INSERT INTO user (id, email, password_hash) VALUES (1, 'a@x.io', 'x')")
+        self.conn.executemany("INSERT INTO coffee (name) VALUES (?)",
+                              [(f'Coffee {i}',) for i in range(5)])
+        self.conn.executemany('''
+            INSERT INTO espresso_entry (user_id, coffee_id, grinder_setting, input_weight,
+                                        output_weight, taste_comment)
+            VALUES (1, ?, ?, 18, ?, ?)
+        ''', [(i % 5 + 1, str(i % 9), 30 + i % 13, f'entry {i}') for i in range(3000)])
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def rows(self, conn):
+        return [tuple(row) for row in conn.execute('''
+            SELECT id, user_id, coffee_id, grinder_setting, input_weight, output_weight,
+                   extraction_ratio, taste_comment
+            FROM espresso_entry ORDER BY id
+        ''')]
+
+    def schema(self, conn):
+        return sorted(tuple(row) for row in conn.execute('''
+            SELECT type, name, sql FROM sqlite_master
+            WHERE tbl_name = 'espresso_entry' AND type IN ('index', 'trigger')
+        '''))
+
+    def test_rebuild_under_concurrent_inserts(self):
+        schema = self.schema(self.conn)
+        reader = self.connect()
+        self.assertEqual(len(self.rows(reader)), 3000)
+
+        # Another connection keeps inserting (and editing) entries until the swap is done
+        done = threading.Event()
+        written = []
+
+        def write():
+            writer = self.connect()
+            while not done.is_set():
+                cursor = writer.execute('''
+                    INSERT INTO espresso_entry (user_id, coffee_id, grinder_setting,
+                                                input_weight, output_weight, taste_comment)
+                    VALUES (1, ?, 'w', 18, 40, 'concurrent')
+                ''', (len(written) % 5 + 1,))
+                written.append(cursor.lastrowid)
+                writer.execute("UPDATE espresso_entry SET taste_comment = 'edited' WHERE id = ?",
+                               (len(written) * 7 % 3000 + 1,))
+                writer.commit()
+            writer.close()
+
+        chunks = []
+
+        def progress(table, last_id, max_id):
+            chunks.append(last_id)
+            # Let the writer in between chunks
+            threading.Event().wait(0.002)
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        try:
+            migrations.copy_table(self.conn, 'espresso_entry', migrations.ENTRY_TABLE_SQL,
+                                  COLUMNS, chunk_size=200, progress=progress)
+            # The indexes are built on the copy, ahead of the swap
+            copies = {row[0] for row in self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?",
+                ('espresso_entry_new',))}
+            self.assertEqual(copies, {f'{name}_new' for kind, name, sql in schema
+                                      if kind == 'index' and sql})
+
+            self.conn.execute('BEGIN IMMEDIATE')
+            expected = self.rows(self.conn)
+            migrations.swap_table(self.conn, 'espresso_entry')
+            self.assertEqual(self.rows(self.conn), expected)
+            self.conn.commit()
+            swapped = len(expected) - 3000
+            # The writer carries on against the new table
+            while len(written) < swapped + 5:
+                threading.Event().wait(0.01)
+        finally:
+            done.set()
+            thread.join()
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual([row[0] for row in expected[3000:]], written[:swapped])
+        self.assertEqual([row[0] for row in self.rows(reader)[3000:]], written)
+
+        self.assertEqual(self.schema(reader), schema)
+        self.assertEqual(reader.execute('PRAGMA integrity_check').fetchone()[0], 'ok')
+        plan = ' '.join(row[3] for row in reader.execute('''
+            EXPLAIN QUERY PLAN
+            SELECT id FROM espresso_entry WHERE coffee_id = 2 ORDER BY created_at DESC
+        '''))
+        self.assertIn('idx_espresso_entry_coffee_created', plan)
+        self.assertIsNone(self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name LIKE '%rebuild%' OR name LIKE '%_new'"
+        ).fetchone())
+        reader.close()
+
+    def test_search_backfill_under_concurrent_writes(self):
+        for name in ('insert', 'update', 'delete', 'coffee_rename'):
+            self.conn.execute(f'DROP TRIGGER trg_entry_fts_{name}')
+        self.conn.execute('DROP TABLE entry_fts')
+        self.conn.commit()
+
+        done = threading.Event()
+        writes = []
+
+        def write():
+            writer = self.connect()
+            while not done.is_set():
+                n = len(writes)
+                writer.execute("""
+                    INSERT INTO espresso_entry (user_id, coffee_id, grinder_setting,
+                                                input_weight, output_weight, taste_comment)
+                    VALUES (1, 1, 'w', 18, 40, 'concurrent')
+                """)
+                writer.execute("UPDATE espresso_entry SET taste_comment = 'edited' WHERE id = ?",
+                               (n * 7 % 3000 + 1,))
+                writer.execute('DELETE FROM espresso_entry WHERE id = ?', (n * 11 % 3000 + 1,))
+                writer.commit()
+                writes.append(n)
+            writer.close()
+
+        def start(conn):
+            migrations._create_search_index(conn.cursor())
+            return conn.execute('SELECT MAX(id) FROM espresso_entry').fetchone()[0]
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        try:
+            migrations.backfill(self.conn, 'entry_fts', start, migrations._fill_search_index,
+                                chunk_size=200,
+                                progress=lambda *args: threading.Event().wait(0.002))
+        finally:
+            done.set()
+            thread.join()
+
+        self.assertGreater(len(writes), 0)
+        self.assertEqual([tuple(row) for row in self.conn.execute("""
+            SELECT rowid, coffee, grinder_setting, taste_comment FROM entry_fts ORDER BY rowid
+        """)], [tuple(row) for row in self.conn.execute("""
+            SELECT e.id, c.name, e.grinder_setting, e.taste_comment
+            FROM espresso_entry e JOIN coffee c ON c.id = e.coffee_id ORDER BY e.id
+        """)])
+        self.conn.execute("INSERT INTO entry_fts (entry_fts) VALUES ('integrity-check')")
+        self.assertIsNone(self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'table_rebuild'").fetchone())
+
+    def test_legacy_upgrade_swaps_in_built_indexes(self):
+        path = os.path.join(self.tmp.name, 'legacy.db')
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        conn.execute(migrations.LEGACY_ENTRY_TABLE_SQL.format(table='espresso_entry'))
+        conn.executemany("""
+            INSERT INTO espresso_entry (user_id, coffee, grinder_setting, input_weight,
+                                        output_weight)
+            VALUES (1, ?, '5', 18, 36)
+        """, [(f'Coffee {i % 4}',) for i in range(50)])
+        conn.commit()
+
+        # Migration 3 copies the table with ENTRY_INDEXES built on the copy,
+        # so migration 10 has nothing left to create
+        migrations.upgrade(conn)
+        indexes = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'espresso_entry'"
+            " AND sql IS NOT NULL")}
+        self.assertEqual(indexes, set(migrations.ENTRY_INDEXES))
+        self.assertEqual(conn.execute('PRAGMA integrity_check').fetchone()[0], 'ok')
+        self.assertEqual([tuple(row) for row in conn.execute(
+            'SELECT name, entry_count FROM coffee ORDER BY name')],
+            [(f'Coffee {i}', 13 if i < 2 else 12) for i in range(4)])
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
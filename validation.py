@@ -0,0 +1,29 @@
+from typing import List
+
+
+def is_valid_number(value) -> bool:
+    """Check if a string is a valid number."""
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def validate_entry(coffee: str, grinder_setting: str, input_weight: str,
+                   output_weight: str) -> List[str]:
+    """Validate espresso entry fields. Returns a list of error messages."""
+    errors = []
+    if not coffee:
+        errors.append('Coffee name is required')
+    if not grinder_setting:
+        errors.append('Grinder setting is required')
+    if not input_weight:
+        errors.append('Input weight is required')
+    elif not is_valid_number(input_weight):
+        errors.append('Input weight must be a valid number')
+    if not output_weight:
+        errors.append('Output weight is required')
+    elif not is_valid_number(output_weight):
+        errors.append('Output weight must be a valid number')
+    return errors